@@ -0,0 +1,329 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""The frame-time benchmark of Bombercan.
+
+Every stage in stagesetting and a free game are run by the headless
+backend with the same scripted input. The tick time, draw time and
+node count of each frame are recorded, and their percentiles are
+written as JSON:
+
+    python benchmark.py -o result.json
+
+With a baseline file, the result is compared against it, and the
+exit status is 1 if any time percentile got slower than the threshold:
+
+    python benchmark.py -b baseline.json -t 0.2
+
+The scaling of the tiled renderer (see tilerender) is measured by
+running frames of a large window, all repainted, in one process 
+and then with 1 to N processes:
+
+    python benchmark.py -s 4
+
+The generation of stages (see stagegen) is timed at 15, 50, 100 and
+200 cells per side, for computing the layout and for creating the nodes:
+
+    python benchmark.py -g
+
+With -p, the time spent by each node class is printed per scenario
+(see pnode.Profiler).
+
+"""
+
+import sys
+import json
+import random
+from time import time
+from optparse import OptionParser
+
+import pnode
+from headless import HeadlessBackend, ScriptedInput
+from tilerender import TiledRenderer
+from framestats import percentile
+import bombercan
+import stagesetting
+import stagegen
+from stagescene import StageScene
+
+PERCENTILES = (50, 95, 99)
+
+# The number of cells per side of maps generated by run_generation()
+GENERATION_SIZES = (15, 50, 100, 200)
+
+def script(duration):
+    """Return the scripted input used in all scenarios.
+
+    The player walks around the start point and drops a bomb
+    on every turn.
+
+    @param duration: the length of the script in seconds
+
+    """
+    events = []
+    moves = ('Right', 'Down', 'Left', 'Up')
+    t = 0.5
+    i = 0
+    while t < duration:
+        key = moves[i % len(moves)]
+        events.append((t, key, True))
+        events.append((t + 0.4, key, False))
+        events.append((t + 0.5, 'z', True))
+        events.append((t + 0.55, 'z', False))
+        t += 1.0
+        i += 1
+
+    return events
+
+def scenarios():
+    """Return a list of (name, mode, stage_num)."""
+    ret = [('stage%d' % i, 0, i) for i in range(len(stagesetting.stage))]
+    ret.append(('free', 1, 0))
+    return ret
+
+def count_nodes(node):
+    """Return the number of nodes in the tree."""
+    count = 1
+    for child in node.children:
+        count += count_nodes(child)
+
+    return count
+
+def summarize(values):
+    """Return a dict of the percentiles of values."""
+    return dict(('p%d' % p, percentile(values, p)) for p in PERCENTILES)
+
+def run_scenario(mode, stage_num, frames, seed=0):
+    """Run one scenario and return its summary.
+
+    @param mode: 0 for story mode, 1 for free game
+        (see Bombercan.game_start())
+    @param frames: the number of frames to be recorded
+
+    """
+    random.seed(seed)
+    game = bombercan.Bombercan(mute=True)
+    # Measure every frame
+    game.max_skip = 0
+    game.game_start(mode, stage_num)
+    duration = frames * game.timer_interval / 1000.0
+    backend = HeadlessBackend(game, input=ScriptedInput(script(duration)))
+    backend.start()
+
+    tick_times = []
+    draw_times = []
+    node_counts = []
+    for i in range(0, frames):
+        # Stop if the player has been sent back to the menu
+        if game.top_node is not game.stage:
+            break
+
+        backend.clock.advance()
+        backend.input.poll(game, backend.clock())
+
+        start = time()
+        game.do_timeout()
+        tick_times.append(time() - start)
+
+        start = time()
+        backend.draw()
+        draw_times.append(time() - start)
+
+        node_counts.append(count_nodes(game.top_node))
+
+    return {
+            'frames': len(tick_times),
+            'tick': summarize(tick_times),
+            'draw': summarize(draw_times),
+            'nodes': summarize(node_counts),
+            }
+
+def run(frames, profile=False):
+    """Run all scenarios and return the result.
+    
+    @param profile: print the profile of each scenario
+
+    """
+    result = {}
+    for name, mode, stage_num in scenarios():
+        pnode.profiler.enabled = profile
+        pnode.profiler.reset()
+        result[name] = run_scenario(mode, stage_num, frames)
+        if profile:
+            print '[%s]' % name
+            print pnode.profiler.report(15)
+            pnode.profiler.enabled = False
+
+    return result
+
+def compare(result, baseline, threshold):
+    """Compare the time percentiles against the baseline.
+
+    Return a list of messages of the regressions.
+
+    @param threshold: the allowed ratio of slowing down (0.2 for 20%)
+
+    """
+    failures = []
+    for name in sorted(result):
+        if name not in baseline:
+            continue
+
+        for metric in ('tick', 'draw'):
+            for key in sorted(result[name][metric]):
+                base = baseline[name][metric].get(key)
+                cur = result[name][metric][key]
+                if base and cur > base * (1 + threshold):
+                    failures.append('%s %s %s: %.3fms > %.3fms (+%d%%)' % (
+                        name, metric, key, cur * 1000, base * 1000,
+                        (cur / base - 1) * 100))
+
+    return failures
+
+def run_scaling(frames, max_processes, size=(1600, 1200)):
+    """Measure the time of a whole frame with the tiled renderer.
+
+    A frame includes the tick and the rasterization of nodes, 
+    which stay in the main process, so the times are comparable 
+    with painting without the renderer (0 processes).
+
+    @param max_processes: measure with 0 to max_processes processes
+    @return: a list of (processes, average time of a frame, 
+        average time of TiledRenderer.upload(), 
+        average time of TiledRenderer.submit())
+
+    """
+    result = []
+    for processes in range(0, max_processes + 1):
+        random.seed(0)
+        game = bombercan.Bombercan(mute=True)
+        game.max_skip = 0
+        # Repaint all in every frame
+        game.damage_tracking = False
+        game.game_start(0, len(stagesetting.stage) - 1)
+        backend = HeadlessBackend(game)
+        worker = None
+        if processes:
+            worker = TiledRenderer(game.width, game.height, processes)
+            game.render_worker = worker
+        backend.start()
+        backend.resize(*size)
+
+        total = upload = submit = 0.0
+        for i in range(0, frames):
+            start = time()
+            backend.step()
+            total += time() - start
+            if worker:
+                upload += worker.upload_cost
+                submit += worker.cost
+
+        if worker:
+            worker.close()
+        result.append((processes, total / frames, upload / frames, 
+            submit / frames))
+
+    return result
+
+def run_generation(repeat, sizes=GENERATION_SIZES):
+    """Measure the time to generate stages of each size.
+
+    @param repeat: the number of layouts generated for each size
+        (Nodes are created from the first one only.)
+    @return: a list of (size, objects, 
+        median time of a layout, time of creating nodes)
+
+    """
+    game = bombercan.Bombercan(mute=True)
+    result = []
+    for size in sizes:
+        times = []
+        for seed in range(0, max(1, repeat)):
+            start = time()
+            layout = stagegen.generate((size, size), seed=seed)
+            times.append(time() - start)
+            if seed == 0:
+                first = layout
+
+        stage = StageScene(
+                parent=game,
+                style={},
+                audio=game.audio,
+                map_size=(size, size), 
+                margin=(20, 20, 20, 20),
+                key_up=game.key_up,
+                key_down=game.key_down,
+                on_game_reset=game.game_reset,
+                on_game_win=game.game_reset
+            )
+        start = time()
+        stage.build(first)
+        build_time = time() - start
+
+        objects = size * size - first.count(stagegen.EMPTY)
+        result.append((size, objects, percentile(times, 50), build_time))
+
+    return result
+
+def main():
+    """The entry point."""
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--frames', type='int', default=600,
+            help='the number of frames in each scenario')
+    parser.add_option('-o', '--output', default='benchmark.json',
+            help='the file to write the result')
+    parser.add_option('-b', '--baseline',
+            help='compare the result against this file')
+    parser.add_option('-t', '--threshold', type='float', default=0.2,
+            help='the allowed ratio of slowing down (default 0.2)')
+    parser.add_option('-p', '--profile', action='store_true', 
+            help='print the time spent by each node class')
+    parser.add_option('-s', '--scaling', type='int', metavar='N',
+            help='measure the tiled renderer with 1 to N processes instead')
+    parser.add_option('-g', '--generation', action='store_true', 
+            help='measure the generation of stages instead')
+    options, args = parser.parse_args()
+
+    if options.generation:
+        # Frames are not run, the option counts layouts instead
+        repeat = min(options.frames, 10)
+        for size, objects, layout_time, build_time in \
+                run_generation(repeat):
+            print '%3dx%-3d %6d objects: layout %.3fms, nodes %.3fms' % (
+                    size, size, objects, 
+                    layout_time * 1000, build_time * 1000)
+        return
+
+    if options.scaling:
+        result = run_scaling(options.frames, options.scaling)
+        base = result[0][1]
+        for processes, cost, upload, submit in result:
+            print ('%2d processes: %.3fms per frame, x%.2f '
+                    '(upload %.3fms, pool %.3fms)') % (
+                    processes, cost * 1000, base / cost if cost else 0,
+                    upload * 1000, (submit - upload) * 1000)
+        return
+
+    result = run(options.frames, options.profile)
+    with open(options.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+    for name in sorted(result):
+        r = result[name]
+        print '%-8s tick p95 = %.3fms, draw p95 = %.3fms, nodes p50 = %d' % (
+                name, r['tick']['p95'] * 1000, r['draw']['p95'] * 1000,
+                r['nodes']['p50'])
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+        failures = compare(result, baseline, options.threshold)
+        for msg in failures:
+            print 'REGRESSION', msg
+
+        if failures:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
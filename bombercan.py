@@ -3,23 +3,48 @@
 
 """The topmost executable module of Bombercan."""
 
+import sys
+
+import pnode
+import tracing
 from pnode import Game
 from menuscene import MenuScene
 from stagescene import StageScene
 from endscene import EndScene
-from printfps import printfps
+from framestats import FrameStats
 from audio import AudioManager
 
 import stagesetting
 
 class Bombercan(Game):
     """The main class of this game."""
-    def __init__(self):
-        """Create the main menu."""
-        super(Bombercan, self).__init__('BomberCan', 500, 500, 80)
+    def __init__(self, mute=False, fps=80, sim_hz=0, 
+            threaded=False, processes=0, stats_file=None):
+        """Create the main menu.
+        
+        @param mute: disable all sounds
+        @param fps: the rate of drawing
+        @param sim_hz: the rate of the fixed-step simulation 
+            (see pnode.Game; 0 to tick once per frame)
+        @param threaded: render frames in a worker thread
+        @param processes: paint by a pool of processes (see tilerender)
+        @param stats_file: the file to export frame statistics 
+            (.csv or .json) on F11
+
+        """
+        super(Bombercan, self).__init__('BomberCan', 500, 500, fps, 
+                sim_hz=sim_hz, threaded=threaded)
+        if processes:
+            # Needed only with --processes
+            from tilerender import TiledRenderer
+            self.render_worker = TiledRenderer(self.width, self.height, 
+                    processes)
+
+        self.frame_stats = FrameStats()
+        self.stats_file = stats_file
 
         # Play BGM
-        self.audio = AudioManager()
+        self.audio = AudioManager(mute)
         self.audio.play('bombercan.wav', loop=True)
             
         # Display the main menu
@@ -105,18 +130,62 @@ class Bombercan(Game):
         self.top_node=self.stage
         self.top_node.do_resize_recursive()
 
-    @printfps()
     def on_tick(self, interval):
-        """Do nothing but print the fps."""
-        pass
+        """Print the frame statistics on F11, 
+        and the profile on F12 if profiling."""
+        if self.key_up('F11'):
+            print self.frame_stats.summary()
+            if self.stats_file:
+                self.frame_stats.export(self.stats_file)
+
+        if pnode.profiler.enabled and self.key_up('F12'):
+            print pnode.profiler.report(20)
+            pnode.profiler.reset()
 
 def main():
-    """The entry point."""
+    """The entry point.
+    
+    Run with --profile to profile nodes (see pnode.Profiler)
+    and report allocations of node surfaces on exit,
+    --stats to print frame statistics on exit 
+    (--stats=FILE to export them as well),
+    --trace=FILE to write a Chrome trace (see tracing.Tracer),
+    and --processes=N to paint by N processes (see tilerender).
+
+    """
+    pnode.profiler.enabled = '--profile' in sys.argv
+    stats = False
+    stats_file = None
+    processes = 0
+    for arg in sys.argv[1:]:
+        if arg == '--stats':
+            stats = True
+        elif arg.startswith('--stats='):
+            stats = True
+            stats_file = arg[len('--stats='):]
+        elif arg.startswith('--trace='):
+            tracing.tracer.start(arg[len('--trace='):])
+        elif arg.startswith('--processes='):
+            processes = int(arg[len('--processes='):])
+
+    game = None
     try: 
-        game = Bombercan()
+        game = Bombercan(processes=processes, stats_file=stats_file)
         game.run()
     except KeyboardInterrupt:
         pass
 
+    tracing.tracer.stop()
+    if game and stats:
+        print 'frames:', game.frame_stats.summary()
+        if stats_file:
+            game.frame_stats.export(stats_file)
+
+    if pnode.profiler.enabled:
+        print pnode.profiler.report()
+        # Allocation counts of node surfaces
+        print 'surface pool:', pnode.surface_pool.report()
+        print 'sprite cache:', pnode.sprite_cache.report()
+
 if __name__ == '__main__':
     main()
@@ -6,9 +6,6 @@
 from math import pi
 from random import random
 
-import gtk
-import gtk.gdk as gdk
-import gobject
 import cairo
 
 from pnode import Node
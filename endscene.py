@@ -3,9 +3,6 @@
 
 """This module contains the game scene 'EndScene'."""
 
-import gtk
-import gtk.gdk as gdk
-import gobject
 import cairo
 
 from pnode import *
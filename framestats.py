@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""This module contains the frame statistics recorder.
+
+The durations of the last frames are kept in a ring buffer,
+so recording costs a few stores per frame,
+and the statistics are computed only when asked.
+
+"""
+
+import json
+from math import ceil
+from array import array
+
+PHASES = ('tick', 'draw', 'idle')
+
+# The upper bounds (in ms) of histogram bins, the last bin is unbounded
+HISTOGRAM_BOUNDS = (1, 2, 4, 8, 12, 16, 25, 33, 50, 100)
+
+def percentile(values, p):
+    """Return the p-th percentile (nearest rank) of the values."""
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = int(ceil(p / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+class FrameStats(object):
+    """The durations of tick, draw and idle of the last frames.
+
+    A frame starts at a tick, followed by drawing (if any),
+    and then idle until the next tick.
+
+    """
+    def __init__(self, size=1024):
+        """Create the ring buffer.
+
+        @param size: the number of frames kept
+
+        """
+        self.size = size
+        self.buffers = dict((phase, array('d', [0.0]) * size)
+                for phase in PHASES)
+        self.pos = 0
+        self.count = 0
+
+    def add(self, tick, draw, idle):
+        """Record a frame (in seconds)."""
+        pos = self.pos
+        buffers = self.buffers
+        buffers['tick'][pos] = tick
+        buffers['draw'][pos] = draw
+        buffers['idle'][pos] = idle
+        self.pos = (pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def values(self, phase):
+        """Return the recorded durations from the oldest to the latest.
+
+        @param phase: 'tick', 'draw', 'idle' or 'total'
+
+        """
+        if phase == 'total':
+            return [sum(frame) for frame in zip(
+                *[self.values(p) for p in PHASES])]
+
+        buf = self.buffers[phase]
+        if self.count < self.size:
+            return buf[:self.count].tolist()
+        return (buf[self.pos:] + buf[:self.pos]).tolist()
+
+    def percentiles(self, phase, ps=(50, 95, 99)):
+        """Return a dict of the percentiles (in seconds)."""
+        values = self.values(phase)
+        return dict(('p%d' % p, percentile(values, p)) for p in ps)
+
+    def histogram(self, phase, bounds=HISTOGRAM_BOUNDS):
+        """Return the number of frames in each bin.
+
+        @param bounds: the upper bounds of bins in ms
+            (there is one more bin for the rest)
+
+        """
+        counts = [0] * (len(bounds) + 1)
+        for value in self.values(phase):
+            ms = value * 1000
+            for i, bound in enumerate(bounds):
+                if ms < bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+
+        return counts
+
+    def fps(self):
+        """Return the average frame rate of the recorded frames."""
+        total = sum(self.values('total'))
+        return self.count / total if total > 0 else 0.0
+
+    def summary(self):
+        """Return the frame rate and percentiles as a string."""
+        parts = ['fps = %.1f' % self.fps()]
+        for phase in PHASES:
+            p = self.percentiles(phase)
+            parts.append('%s p50/p95/p99 = %.2f/%.2f/%.2fms' % (
+                phase, p['p50'] * 1000, p['p95'] * 1000, p['p99'] * 1000))
+
+        return ', '.join(parts)
+
+    def to_dict(self):
+        """Return all statistics and the frames as a dictionary."""
+        return {
+                'fps': self.fps(),
+                'frames': self.count,
+                'histogram_bounds_ms': list(HISTOGRAM_BOUNDS),
+                'phases': dict((phase, {
+                    'percentiles': self.percentiles(phase),
+                    'histogram': self.histogram(phase),
+                    'values': self.values(phase),
+                    }) for phase in PHASES + ('total', )),
+                }
+
+    def export(self, filename):
+        """Write the frames to a CSV file, or all statistics to
+        a JSON file if the name ends with .json."""
+        with open(filename, 'w') as f:
+            if filename.endswith('.json'):
+                json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+                return
+
+            f.write(','.join(PHASES) + '\n')
+            for frame in zip(*[self.values(phase) for phase in PHASES]):
+                f.write(','.join(['%.6f' % v for v in frame]) + '\n')
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""The headless backend of the pnode framework.
+
+It drives a Game without any window: the same do_timeout() and
+do_update_recursive() are called, but frames are painted onto an
+offscreen image surface. Time and key events could be supplied by
+the caller, so that a run is reproducible.
+
+This module does not need gtk.
+
+"""
+
+from time import time
+
+import cairo
+
+from pnode import merge_rects
+
+class FixedClock(object):
+    """A clock advancing by a fixed step on every frame."""
+    def __init__(self, fps, start=0.0):
+        """Create the clock.
+
+        @param fps: the number of frames in a simulated second
+        @param start: the initial time in seconds
+
+        """
+        self.step = 1.0 / fps
+        self.now = start
+
+    def __call__(self):
+        """Return the current time in seconds."""
+        return self.now
+
+    def advance(self):
+        """Move on to the next frame."""
+        self.now += self.step
+
+class RealClock(object):
+    """The wall clock (the frames run as fast as possible)."""
+    def __call__(self):
+        return time()
+
+    def advance(self):
+        pass
+
+class ScriptedInput(object):
+    """A synthetic input source replaying a list of key events."""
+    def __init__(self, events):
+        """Create the input source.
+
+        @param events: a list of (time, keyname, pressed),
+            where pressed is True for a key press and False for a release
+
+        """
+        self.events = sorted(events, key=lambda e: e[0])
+        self.pos = 0
+
+    def poll(self, game, now):
+        """Feed the game with all events happened before now."""
+        while self.pos < len(self.events) and self.events[self.pos][0] <= now:
+            t, keyname, pressed = self.events[self.pos]
+            key = game.keyval_from_name(keyname)
+            if pressed:
+                game.press_key(key)
+            else:
+                game.release_key(key)
+
+            self.pos += 1
+
+class HeadlessBackend(object):
+    """Run a Game onto an offscreen image surface.
+
+    The backend takes the place of the drawing area of the game,
+    so the damage queued by Game.queue_damage() is collected here
+    and repainted on the next draw.
+
+    """
+    def __init__(self, game, clock=None, input=None):
+        """Attach the backend to the game.
+
+        @param clock: the clock to be used by the game
+            (The default value None means a FixedClock at the game's fps.)
+        @param input: an object with method poll(game, now),
+            e.g. ScriptedInput (None for no input)
+
+        """
+        self.game = game
+        if clock is None:
+            clock = FixedClock(1000.0 / game.timer_interval)
+
+        self.clock = clock
+        self.input = input
+        self.frames = 0
+        self.full_damage = True
+        self.damage = []
+        self.surface = None
+
+        game.clock = clock
+        game.area = self
+        game.main_quit = self.main_quit
+
+    # The interface of gtk.DrawingArea used by Game
+
+    def queue_draw(self):
+        self.full_damage = True
+
+    def queue_draw_area(self, x, y, w, h):
+        self.damage.append((x, y, w, h))
+
+    def main_quit(self):
+        pass
+
+    def start(self):
+        """Create the offscreen surface and reset the game time."""
+        game = self.game
+        self.surface = cairo.ImageSurface(
+                cairo.FORMAT_ARGB32, game.width, game.height)
+        game.resize(game.width, game.height)
+        game.cur_time = self.clock()
+        game.interval = 0
+        game.accumulator = 0.0
+        game.draw_interval = 0.0
+        self.full_damage = True
+        self.damage = []
+
+    def resize(self, width, height):
+        """Resize the game and the offscreen surface."""
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self.game.resize(width, height)
+        self.full_damage = True
+
+    def step(self):
+        """Run one frame: tick the game and paint it.
+
+        Return false if the game has quit.
+
+        """
+        if self.surface is None:
+            self.start()
+
+        game = self.game
+        if game.has_quit():
+            return False
+
+        self.clock.advance()
+        if self.input:
+            self.input.poll(game, self.clock())
+
+        game.do_timeout()
+        self.draw()
+        self.frames += 1
+        return True
+
+    def draw(self):
+        """Paint the damaged area onto the offscreen surface."""
+        clip = None
+        if not self.full_damage:
+            if not self.damage:
+                return
+
+            clip = merge_rects(self.damage)
+
+        self.full_damage = False
+        self.damage = []
+        cr = cairo.Context(self.surface)
+        self.game.draw(cr, clip)
+
+    def run(self, frames=None):
+        """Run until the game quits or the number of frames is reached.
+
+        Return the number of frames run.
+
+        """
+        count = 0
+        while frames is None or count < frames:
+            if not self.step():
+                break
+
+            count += 1
+
+        return count
+
+    def write_to_png(self, filename):
+        """Save the last frame."""
+        self.surface.write_to_png(filename)
@@ -3,9 +3,6 @@
 
 """This module contains the game scene 'MenuScene'."""
 
-import gtk
-import gtk.gdk as gdk
-import gobject
 import cairo
 
 from pnode import *
@@ -104,7 +101,6 @@ class MenuScene(Node):
         x = (self.width - new_width) / 2
         y = (self.height - new_height) / 2
 
-        cr = cairo.Context(self.surface)
         cr.scale(scale, scale)
         cr.set_source_rgb(0, 0, 0)
         cr.paint()
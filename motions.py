@@ -55,10 +55,10 @@ def use_basic_motions(node):
 
         if harmonic:
             self.add_action('scale', _scale_harmonic, 
-                    duration, delay, True, loop, cleanup)
+                    duration, delay, False, loop, cleanup)
         else:
             self.add_action('scale', _scale, 
-                    duration, delay, True, loop, cleanup)
+                    duration, delay, False, loop, cleanup)
 
     node.scale = instancemethod(scale, node)
 
@@ -72,6 +72,6 @@ def use_basic_motions(node):
             self.set_rotate(start_ang + delta * phase)
 
         self.add_action('rotate', _rotate, 
-                duration, delay, True, loop, cleanup)
+                duration, delay, False, loop, cleanup)
 
     node.rotate = instancemethod(rotate, node)
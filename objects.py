@@ -10,15 +10,14 @@ from math import pi
 from math import sin
 from math import cos
 
-import gtk
-import gtk.gdk as gdk
-import gobject
 import cairo
 
 from pnode import *
 from motions import *
 
 class Bomb(Node):
+    cache_sprite = True
+
     def __init__(self, parent, style):
         super(Bomb, self).__init__(parent, style)
         use_basic_motions(self)
@@ -60,6 +59,8 @@ class Bomb(Node):
                 rel_origin=(0.5, 0.8), harmonic=True, loop=True)
 
 class HardBlock(Node):
+    cache_sprite = True
+
     def on_update(self, cr):
         # Draw a mountain-like shape
         cr.move_to(self.width * 0.15, self.height * 0.85)
@@ -81,6 +82,8 @@ class HardBlock(Node):
         cr.stroke()
 
 class SoftBlock(Node):
+    cache_sprite = True
+
     def on_update(self, cr):
         width, height = self.width, self.height
 
@@ -117,6 +120,8 @@ class SoftBlock(Node):
         cr.stroke()
 
 class Can(Node):
+    cache_sprite = True
+
     def _draw_feet(self, cr, x, y, inverse=1):
         width, height = self.width, self.height
         cr.move_to(x, y)
@@ -215,7 +220,7 @@ class Can(Node):
         self._draw_eyes(cr)
         cr.restore()
 
-    @animation
+    @animation(frames=16)
     def play_moving(self, cr, phase):
         """This animation is displayed when it is moving.
         
@@ -258,7 +263,7 @@ class BadCan(Can):
         self._draw_eyes(cr)
         cr.restore()
 
-    @animation
+    @animation(frames=16)
     def play_moving(self, cr, phase):
         """Same with play_moving() in class Can."""
         width, height = self.width, self.height
@@ -279,6 +284,8 @@ class BadCan(Can):
 
 class Enemy(Node):
     class Eyes(Node):
+        cache_sprite = True
+
         def on_update(self, cr):
             # Draw the eyes
             width, height = self.width, self.height
@@ -319,6 +326,8 @@ class Enemy(Node):
         use_basic_motions(self)
 
 class Bishi(Enemy):
+    cache_sprite = True
+
     def on_update(self, cr):
         # Draw the purpple diamond-like body
         cr.move_to(self.width / 2, 0)
@@ -332,6 +341,8 @@ class Bishi(Enemy):
         cr.stroke()
 
 class Drop(Enemy):
+    cache_sprite = True
+
     def _draw(self, cr, phase):
         width, height = self.width, self.height
         phase = sin(phase * 2 * pi)
@@ -357,11 +368,13 @@ class Drop(Enemy):
     def on_update(self, cr):
         self._draw(cr, 1)
         
-    @animation
+    @animation(frames=24)
     def play_moving(self, cr, phase):
         self._draw(cr, phase)
 
 class Ameba(Enemy):
+    cache_sprite = True
+
     def _draw(self, cr, phase):
         width, height = self.width, self.height
         phase = sin(phase * 2 * pi)
@@ -418,7 +431,7 @@ class Ameba(Enemy):
     def on_update(self, cr):
         self._draw(cr, 1.0)
 
-    @animation
+    @animation(frames=24)
     def play_moving(self, cr, phase):
         self._draw(cr, phase)
 
@@ -441,15 +454,25 @@ class Floor(Node):
         self.color = (0.5, 0.5, 1, 0.7)
         self._draw_simple_pattern(cr, self.color)
 
-    @animation
-    def play_blink(self, cr, phase):
+    def _blink_color(self, phase):
         c = cos(phase * pi * 2)
-        self.color = (
+        return (
                 0.75 - 0.25 * c, 
                 0.25 + 0.25 * c, 
                 0.5 + 0.5 * c,
                 0.7)
-        self._draw_simple_pattern(cr, self.color)
+
+    @animation(frames=16)
+    def play_blink(self, cr, phase):
+        self._draw_simple_pattern(cr, self._blink_color(phase))
+
+    def stop_blink(self, duration):
+        """Fade out from the current color of blinking."""
+        phase = self.get_animation_phase()
+        if phase is not None:
+            self.color = self._blink_color(phase)
+
+        self.play_fadeout(duration=duration)
 
     @animation
     def play_fadeout(self, cr, phase):
@@ -462,6 +485,8 @@ class Floor(Node):
         self._draw_simple_pattern(cr, tmp_color)
 
 class FireItem(Node):
+    cache_sprite = True
+
     def on_update(self, cr):
         width = self.width
         height = self.height
@@ -513,6 +538,8 @@ class FireItem(Node):
         cr.fill()
 
 class BombItem(Node):
+    cache_sprite = True
+
     def on_update(self, cr):
         width = self.width
         height = self.height
@@ -5,17 +5,37 @@
 
 There are only two core classes in this framework: Node and Game.
 
+GTK is needed only by Game.run(). Without it, 
+games could still be run by the headless backend (see module headless).
+
 """
 
 from math import sqrt
+from math import floor
+from math import ceil
 from time import time
 from functools import wraps
+from threading import Thread, Condition, Lock
+from bisect import insort, bisect_left
+from heapq import heappush, heappop
+from itertools import count
+from collections import OrderedDict
+
+try:
+    import gtk
+    import gtk.gdk as gdk
+    import gobject
+except ImportError:
+    gtk = None
+    gdk = None
 
-import gtk
-import gtk.gdk as gdk
-import gobject
 import cairo
 
+from tracing import tracer, traced
+
+# Recording surfaces came with pycairo 1.10
+RecordingSurface = getattr(cairo, 'RecordingSurface', None)
+
 # The keywords for style, the order stands for the priority of evaluation
 _style_key = ['width', 'height', 'left', 'top', 'right', 
     'bottom', 'aspect', 'align', 'vertical-align', 'z-index']
@@ -46,44 +66,58 @@ def parse_value(value, rel):
     else:
         return value
 
-def evaluate_style(node, style):
-    """Evaluate the style."""
-    # defaults
-    node.x = 0
-    node.y = 0
-    node.z_index = 0
-    node.width = node.parent.width
-    node.height = node.parent.height
-
-    # parse style
-    has_width = False
-    has_height = False
-    keys = style.keys()
-    keys.sort(key=style_key_prio)
-    for k in keys:
-        value = style[k]
-        if k == 'width':
-            node.width = parse_value(value, node.parent.width)
-            has_width = True
-        elif k == 'height':
-            node.height = parse_value(value, node.parent.height)
-            has_height = True
-        elif k == 'left':
-            node.x = parse_value(value, node.parent.width)
-        elif k == 'top':
-            node.y = parse_value(value, node.parent.height)
-        elif k == 'right':
-            if has_width:
-                node.x = node.parent.width - node.width - parse_value(value, node.parent.width)
-            else:
-                node.width = node.parent.width - node.x - parse_value(value, node.parent.width)
-        elif k == 'bottom':
-            if has_height:
-                node.y = node.parent.height - node.height - parse_value(value, node.parent.height)
-            else:
-                node.height = node.parent.height - node.y - parse_value(value, node.parent.height)
-        elif k == 'aspect':
-            ratio = float(value)    # width / height
+def _compile_length(value):
+    """Return a function(rel) returning the value of a length keyword.
+    
+    See parse_value() for the types allowed.
+
+    """
+    if value.__class__ is str:
+        value = value.strip()
+        if value[-1] is '%':
+            percent = float(value[0:-1])
+            return lambda rel: int(rel * percent / 100)
+
+    return lambda rel: value
+
+def _compile_key(k, value, has_width, has_height):
+    """Return a function(node, parent) evaluating one keyword,
+    or None if the keyword is unknown."""
+    if k == 'width':
+        length = _compile_length(value)
+        def _evaluate(node, parent):
+            node.width = length(parent.width)
+    elif k == 'height':
+        length = _compile_length(value)
+        def _evaluate(node, parent):
+            node.height = length(parent.height)
+    elif k == 'left':
+        length = _compile_length(value)
+        def _evaluate(node, parent):
+            node.x = length(parent.width)
+    elif k == 'top':
+        length = _compile_length(value)
+        def _evaluate(node, parent):
+            node.y = length(parent.height)
+    elif k == 'right':
+        length = _compile_length(value)
+        if has_width:
+            def _evaluate(node, parent):
+                node.x = parent.width - node.width - length(parent.width)
+        else:
+            def _evaluate(node, parent):
+                node.width = parent.width - node.x - length(parent.width)
+    elif k == 'bottom':
+        length = _compile_length(value)
+        if has_height:
+            def _evaluate(node, parent):
+                node.y = parent.height - node.height - length(parent.height)
+        else:
+            def _evaluate(node, parent):
+                node.height = parent.height - node.y - length(parent.height)
+    elif k == 'aspect':
+        ratio = float(value)    # width / height
+        def _evaluate(node, parent):
             if ratio == 1.0:
                 minimum = min(node.height, node.width)
                 node.height, node.width = minimum, minimum
@@ -91,31 +125,942 @@ def evaluate_style(node, style):
                 node.height = node.width / ratio
             else:
                 node.width = node.height * ratio
-        elif k == 'align':
+    elif k == 'align':
+        def _evaluate(node, parent):
             if value == 'center':
-                node.x = (node.parent.width - node.width) / 2.0
+                node.x = (parent.width - node.width) / 2.0
             elif value == 'left':
                 node.x = 0
             elif value == 'right':
-                node.x = node.parent.width - node.width
-        elif k == 'vertical-align':
+                node.x = parent.width - node.width
+    elif k == 'vertical-align':
+        def _evaluate(node, parent):
             if value == 'center':
-                node.y = (node.parent.height - node.height) / 2.0
+                node.y = (parent.height - node.height) / 2.0
             elif value == 'top':
                 node.y = 0
             elif value == 'bottom':
-                node.y = node.parent.height - node.height
-        elif k == 'z-index':
-            node.z_index = int(value)
+                node.y = parent.height - node.height
+    elif k == 'z-index':
+        z_index = int(value)
+        def _evaluate(node, parent):
+            node.z_index = z_index
+    else:
+        return None
+
+    return _evaluate
+
+# The compiled styles by their items (see compile_style())
+_compiled_styles = {}
+
+def compile_style(style):
+    """Compile the style into a function(node) evaluating it.
+    
+    Keywords are sorted and values are parsed only once here, 
+    so evaluating it again after the parent is resized 
+    does only the arithmetic.
+    The same styles (eg. of all floors in a stage) are compiled once.
+
+    """
+    try:
+        # 1 and 1.0 are equal keys, but not the same in evaluation
+        key = frozenset([(k, v, v.__class__) 
+            for k, v in style.iteritems()])
+    except TypeError:
+        # Unhashable values
+        return _compile_style(style)
+
+    compiled = _compiled_styles.get(key)
+    if compiled is None:
+        if len(_compiled_styles) >= 1024:
+            _compiled_styles.clear()
+        compiled = _compiled_styles[key] = _compile_style(style)
+
+    return compiled
+
+def _compile_style(style):
+    has_width = 'width' in style
+    has_height = 'height' in style
+    steps = []
+    for k in sorted(style, key=style_key_prio):
+        step = _compile_key(k, style[k], has_width, has_height)
+        if step:
+            steps.append(step)
+
+    def _evaluate_style(node):
+        parent = node.parent
+        # defaults
+        node.x = 0
+        node.y = 0
+        node.z_index = 0
+        node.width = parent.width
+        node.height = parent.height
+        for step in steps:
+            step(node, parent)
+
+    return _evaluate_style
+
+def evaluate_style(node, style):
+    """Evaluate the style."""
+    compile_style(style)(node)
+
+def rect_intersects(a, b):
+    """Return true if two rectangles (x, y, width, height) overlap."""
+    return (a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and
+            a[1] < b[1] + b[3] and b[1] < a[1] + a[3])
+
+def rect_union(a, b):
+    """Return the smallest rectangle containing both rectangles."""
+    x = min(a[0], b[0])
+    y = min(a[1], b[1])
+    return (x, y, 
+            max(a[0] + a[2], b[0] + b[2]) - x, 
+            max(a[1] + a[3], b[1] + b[3]) - y)
+
+def merge_rects(rects, limit=32):
+    """Merge overlapping rectangles.
+    
+    Rectangles are snapped to the pixel grid, 
+    and empty rectangles are dropped.
+
+    @param limit: the maximum number of rectangles kept apart
+        (When there are more, they are merged into their bounding box, 
+        so the cost of merging stays linear in the number of rects.)
+    @return: a list of non-overlapping rectangles in integer
+    
+    """
+    merged = []
+    for r in rects:
+        if r[2] <= 0 or r[3] <= 0:
+            continue
+
+        x, y = int(floor(r[0])), int(floor(r[1]))
+        r = (x, y, int(ceil(r[0] + r[2])) - x, int(ceil(r[1] + r[3])) - y)
+        if len(merged) >= limit:
+            for other in merged:
+                r = rect_union(other, r)
+            merged = [r]
+            continue
+
+        i = 0
+        while i < len(merged):
+            if rect_intersects(merged[i], r):
+                # The union may overlap others, so start over
+                r = rect_union(merged.pop(i), r)
+                i = 0
+            else:
+                i += 1
+
+        merged.append(r)
+
+    return merged
+
+def animation(f=None, frames=0):
+    """A decorator for animation.
+    
+    Use it as @animation, or @animation(frames=N) to cache the frames.
+    With the frame cache, the phase is quantized into N frames.
+    Each frame is drawn once for nodes with the same class and size,
+    then the rasterized frame is shared by those nodes.
+    So the decorated function should depend only on the size and phase.
+
+    @param frames: the number of cached frames 
+        (The default value 0 disables the frame cache.)
+
+    """
+    def _decorate(f):
+        @wraps(f)
+        def _animation(self, duration, 
+                delay=0.0, loop=False, cleanup=None, pend=False):
+            self.set_animation(f, duration, delay, loop, cleanup, pend, 
+                    frames)
+
+        return _animation
+
+    if f is None:
+        return _decorate
+    else:
+        return _decorate(f)
+
+class NodeList(object):
+    """An ordered set of nodes, e.g. the sub-nodes of a node.
+
+    Nodes are iterated in the order they joined, 
+    and a node is removed in O(1) instead of searching a list.
+    The list for iteration is built again only after a change, 
+    so a loop is not disturbed by nodes added or removed in it.
+
+    """
+    __slots__ = ('nodes', 'cache')
+
+    def __init__(self, nodes=()):
+        self.nodes = OrderedDict()
+        self.cache = None
+        for node in nodes:
+            self.append(node)
+
+    def append(self, node):
+        """Add the node to the end (nothing is done if it is there)."""
+        if node not in self.nodes:
+            self.nodes[node] = None
+            self.cache = None
+
+    def remove(self, node):
+        """Remove the node, raise KeyError if it is not there."""
+        del self.nodes[node]
+        self.cache = None
+
+    def discard(self, node):
+        """Remove the node if it is there."""
+        if node in self.nodes:
+            self.remove(node)
+
+    def as_list(self):
+        """Return the nodes as a list (do not modify it)."""
+        if self.cache is None:
+            self.cache = self.nodes.keys()
+        return self.cache
 
-def animation(f):
-    """A decorator for animation."""
-    @wraps(f)
-    def _animation(self, duration, 
-            delay=0.0, loop=False, cleanup=None, pend=False):
-        self.set_animation(f, duration, delay, loop, cleanup, pend)
+    def __iter__(self):
+        return iter(self.as_list())
 
-    return _animation
+    def __reversed__(self):
+        return reversed(self.as_list())
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+class RenderOrder(object):
+    """The persistent drawing order of a tree of nodes.
+
+    Nodes are kept in buckets keyed by their absolute z-index.
+    Only nodes being added, removed or moved to another z-index 
+    are touched, instead of sorting the whole tree in every frame.
+    Nodes with the same z-index are drawn in the order they joined.
+
+    Each node gets a sequence number when it joins (render_seq), 
+    and a bucket keeps its nodes sorted by it, so a node is found 
+    by bisection, and gets back its place after its z-index changes.
+
+    """
+    def __init__(self, root):
+        """Create the drawing order of root and all it's sub-nodes.
+        
+        @type root: pnode.Node
+
+        """
+        self.root = root
+        self.keys = []      # sorted keys of buckets (the inverse of z-index)
+        self.buckets = {}   # key -> (sorted render_seq, nodes)
+        self.seqs = count()
+        self.insert(root)
+
+    def _add(self, node):
+        key = -node.render_z
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = ([node.render_seq], [node])
+            insort(self.keys, key)
+        else:
+            seqs, nodes = bucket
+            i = bisect_left(seqs, node.render_seq)
+            seqs.insert(i, node.render_seq)
+            nodes.insert(i, node)
+
+    def _discard(self, node):
+        key = -node.render_z
+        seqs, nodes = self.buckets[key]
+        i = bisect_left(seqs, node.render_seq)
+        del seqs[i]
+        del nodes[i]
+        if not seqs:
+            del self.buckets[key]
+            del self.keys[bisect_left(self.keys, key)]
+
+    def _insert(self, node, renumber):
+        if node is self.root:
+            z = 0
+        else:
+            z = node.parent.render_z
+
+        stack = [(node, z)]
+        while stack:
+            current, z = stack.pop()
+            # The z-index is inherited from the parent node.
+            current.render_order = self
+            current.render_z = z + current.z_index
+            if renumber:
+                current.render_seq = next(self.seqs)
+            self._add(current)
+            stack.extend([(child, current.render_z) 
+                for child in reversed(current.children)])
+
+    def insert(self, node):
+        """Insert the node and all sub-nodes.
+        
+        The parent of node should have been inserted already.
+
+        """
+        self._insert(node, True)
+
+    def remove(self, node):
+        """Remove the node and all sub-nodes."""
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            self._discard(current)
+            current.render_order = None
+            stack.extend(current.children)
+
+    def update(self, node):
+        """Re-order the node and all sub-nodes after it's z-index changed.
+        
+        They keep their places among nodes with the same z-index.
+
+        """
+        self.remove(node)
+        self._insert(node, False)
+
+    def snapshot(self):
+        """Return a list of nodes in the drawing order."""
+        nodes = []
+        for key in self.keys:
+            nodes.extend(self.buckets[key][1])
+
+        return nodes
+
+class ActionRecord(object):
+    """The record of an action or an animation (see Node.add_action())."""
+    __slots__ = ('node', 'name', 'func', 'duration', 'delay', 'update', 
+            'loop', 'cleanup', 'frames', 'elapsed', 'started', 
+            'due', 'token')
+
+    def __init__(self, node, name, func, duration, delay, 
+            update=False, loop=False, cleanup=None, frames=0):
+        self.node = node
+        self.name = name
+        self.func = func
+        self.duration = float(duration)
+        self.delay = float(delay)
+        self.update = bool(update)
+        self.loop = bool(loop)
+        self.cleanup = cleanup
+        self.frames = int(frames)
+        self.elapsed = 0.0
+        self.started = False
+        self.due = 0.0      # the time to start in the scheduler
+        self.token = 0      # identifies the valid entry in the timer heap
+
+def overrides_tick(node):
+    """Return true if the node has its own on_tick() method."""
+    return 'on_tick' in node.__dict__ or \
+            type(node).on_tick.__func__ is not Node.on_tick.__func__
+
+class Scheduler(object):
+    """The actions and ticking nodes of a tree of nodes.
+
+    Actions waiting for their delay are kept in a heap of due times,
+    so they cost nothing until they start.
+    Only running actions are performed in each tick.
+
+    Nodes without their own on_tick() method are never visited 
+    in a tick; the others are kept in a pnode.NodeList (in the
+    order they joined the tree, parent nodes first).
+
+    """
+    def __init__(self, root):
+        """Create the scheduler of root and all it's sub-nodes.
+        
+        @type root: pnode.Node
+
+        """
+        self.root = root
+        self.now = 0.0
+        self.heap = []                  # (due time, token, record)
+        self.running = OrderedDict()    # record -> None, in starting order
+        self.tokens = count(1)
+        self.ticking = NodeList()
+        self.insert(root)
+
+    def insert(self, node):
+        """Take over the actions of the node and all sub-nodes.
+        
+        Whether a node has to be ticked is checked here, so 
+        on_tick() should be set before the node joins the tree.
+
+        """
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            current.scheduler = self
+            if overrides_tick(current):
+                self.ticking.append(current)
+            for record in current.action_list.itervalues():
+                self.add(record)
+            stack.extend(reversed(current.children))
+
+    def remove(self, node):
+        """Give back the actions of the node and all sub-nodes.
+        
+        Their states are kept, until they are inserted again.
+
+        """
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            current.scheduler = None
+            self.ticking.discard(current)
+            for record in current.action_list.itervalues():
+                self.discard(record)
+            stack.extend(current.children)
+
+    def add(self, record):
+        """Schedule an action."""
+        if record.started:
+            self.running[record] = None
+        else:
+            record.due = self.now + record.delay
+            record.token = next(self.tokens)
+            heappush(self.heap, (record.due, record.token, record))
+
+    def discard(self, record):
+        """Unschedule an action."""
+        if record.started:
+            self.running.pop(record, None)
+        elif record.token:
+            # The entry in the heap is ignored when it pops
+            record.delay = max(record.due - self.now, 0.0)
+            record.token = 0
+
+    def finish(self, record):
+        """Remove the action from its node, and call the cleanup."""
+        self.discard(record)
+        node = record.node
+        if node.action_list.get(record.name) is record:
+            del node.action_list[record.name]
+        if record.cleanup: record.cleanup()
+
+    def tick(self, interval):
+        """Perform the running actions, then start actions due."""
+        self.now += interval
+        profiling = profiler.enabled
+        running = self.running
+        for record in running.keys():
+            if record not in running:
+                # Removed by another action
+                continue
+
+            # Check it's life
+            record.elapsed += interval
+            if record.elapsed > record.duration:
+                if record.loop:
+                    # XXX: if duration is too small?
+                    record.elapsed -= record.duration
+                else:
+                    self.finish(record)
+                    continue
+
+            phase = 0.0 if record.duration <= 0.0 \
+                        else record.elapsed / record.duration
+            node = record.node
+            # Perform the action
+            if profiling:
+                start = time()
+                record.func(node, interval, phase)
+                profiler.add(node, 'action ' + record.name, start)
+            else:
+                record.func(node, interval, phase)
+
+            if record.update:
+                # Mark as "need to update".
+                # It is cleaned in do_update_recursive().
+                node.action_need_update = True
+                node.notify_damage()
+
+        heap = self.heap
+        while heap and heap[0][0] <= self.now:
+            due, token, record = heappop(heap)
+            if token != record.token:
+                # Discarded
+                continue
+
+            record.token = 0
+            record.started = True
+            if record.func is None:
+                # A timer
+                self.finish(record)
+            else:
+                # Performed from the next tick
+                running[record] = None
+
+class SurfacePool(object):
+    """A pool of cairo surfaces to be reused by nodes.
+
+    Sizes are rounded up to buckets, so a node changing it's size 
+    slightly (eg. while scaling) gets back the surface it just released.
+    Idle surfaces are evicted in LRU order when they exceed max_bytes.
+
+    In arena mode, surfaces smaller than arena_slot are packed 
+    into shared large surfaces as fixed-size slots.
+    Nodes owning a slot have to clip to it (see Node.composite()).
+
+    """
+    def __init__(self, granularity=16, max_bytes=32 * 1024 * 1024, 
+            arena_size=0, arena_slot=64):
+        """Initialize the pool.
+        
+        @param granularity: the width and height of surfaces 
+            are rounded up to multiples of this value
+        @param max_bytes: the max amount of memory held by idle surfaces
+        @param arena_size: the size of the shared surfaces in arena mode
+            (The default value 0 disables arena mode.)
+        @param arena_slot: the size of one slot in arena mode
+
+        """
+        self.granularity = granularity
+        self.max_bytes = max_bytes
+        self.arena_size = arena_size
+        self.arena_slot = arena_slot
+
+        self.free = {}              # bucket -> list of idle surfaces
+        self.lru = OrderedDict()    # id of surface -> (bucket, surface)
+        self.free_bytes = 0
+        self.arenas = set()
+        self.free_slots = []        # list of (arena, x, y, used before)
+
+        self.stats = {
+                'allocated': 0, 
+                'reused': 0, 
+                'released': 0, 
+                'evicted': 0,
+                'arenas': 0,
+                }
+
+    def _bucket(self, width, height):
+        g = self.granularity
+        return (max(g, int(ceil(width / float(g))) * g), 
+                max(g, int(ceil(height / float(g))) * g))
+
+    def acquire(self, width, height):
+        """Return a surface at least as large as width x height.
+        
+        The content of the surface is undefined.
+
+        @return: (surface, slot), where slot is the position 
+            of the area in a shared surface, or None
+
+        """
+        slot_size = self.arena_slot
+        if self.arena_size and width <= slot_size and height <= slot_size:
+            if not self.free_slots:
+                self._create_arena()
+            arena, x, y, used = self.free_slots.pop()
+            if used:
+                self.stats['reused'] += 1
+            return (arena, (x, y))
+
+        bucket = self._bucket(width, height)
+        surfaces = self.free.get(bucket)
+        if surfaces:
+            surface = surfaces.pop()
+            del self.lru[id(surface)]
+            self.free_bytes -= bucket[0] * bucket[1] * 4
+            self.stats['reused'] += 1
+            return (surface, None)
+
+        self.stats['allocated'] += 1
+        return (cairo.ImageSurface(cairo.FORMAT_ARGB32, *bucket), None)
+
+    def _create_arena(self):
+        size, slot_size = self.arena_size, self.arena_slot
+        arena = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+        self.arenas.add(arena)
+        self.stats['allocated'] += 1
+        self.stats['arenas'] += 1
+        for x in xrange(0, size - slot_size + 1, slot_size):
+            for y in xrange(0, size - slot_size + 1, slot_size):
+                self.free_slots.append((arena, x, y, False))
+
+    def release(self, surface, slot=None):
+        """Give back a surface (or a slot) returned by acquire()."""
+        self.stats['released'] += 1
+        if slot is not None:
+            if surface in self.arenas:
+                self.free_slots.append((surface, slot[0], slot[1], True))
+            return
+
+        bucket = (surface.get_width(), surface.get_height())
+        if bucket != self._bucket(*bucket):
+            # Not created by this pool
+            return
+
+        self.free.setdefault(bucket, []).append(surface)
+        self.lru[id(surface)] = (bucket, surface)
+        self.free_bytes += bucket[0] * bucket[1] * 4
+
+        # Evict the least recently released surfaces
+        while self.free_bytes > self.max_bytes:
+            bucket, surface = self.lru.popitem(last=False)[1]
+            self.free[bucket].remove(surface)
+            self.free_bytes -= bucket[0] * bucket[1] * 4
+            self.stats['evicted'] += 1
+
+    def report(self):
+        """Return the allocation counts as a string."""
+        return ', '.join(['%s = %d' % (k, self.stats[k]) 
+            for k in sorted(self.stats.keys())])
+
+# The pool used by all nodes
+surface_pool = SurfacePool()
+
+# Numbers the contents painted into node surfaces (see Node.mark_painted())
+paint_serials = count(1)
+
+def _surface_context(surface, slot, width, height, clip):
+    """Return a context of the area in the surface, 
+    cleared in the rectangles of clip (or all) and clipped to them."""
+    cr = cairo.Context(surface)
+    if slot is not None:
+        cr.translate(*slot)
+        cr.rectangle(0, 0, width, height)
+        cr.clip()
+
+    if clip is not None:
+        for rect in clip:
+            cr.rectangle(*rect)
+        cr.clip()
+
+    cr.save()
+    cr.set_operator(cairo.OPERATOR_CLEAR)
+    cr.paint()
+    cr.restore()
+    return cr
+
+def rasterize(job):
+    """Replay a recording taken by RasterQueue into it's surface."""
+    surface, slot, width, height, clip, recording = job
+    cr = _surface_context(surface, slot, width, height, clip)
+    cr.set_source_surface(recording, 0, 0)
+    cr.paint()
+
+class RasterQueue(object):
+    """The rasterization of surfaces put off to RenderWorker.
+
+    While it is enabled, the contexts for painting surfaces 
+    (see Node.create_context() and SpriteCache) draw into 
+    cairo recording surfaces, which only keep the drawing commands. 
+    The recordings are the snapshot of the frame. They do not refer 
+    to nodes, so the worker could replay them into the surfaces 
+    (see rasterize()) while nodes are changing.
+
+    Without recording surfaces in cairo, surfaces are painted at once.
+
+    """
+    def __init__(self):
+        self.enabled = False
+        self.jobs = []  # (surface, slot, width, height, clip, recording)
+
+    def create_context(self, surface, slot, width, height, clip=None):
+        """Return a context to paint the surface, or the slot in it.
+
+        The area is cleared, and the drawing is clipped to it.
+
+        @param slot: the position of the area in the surface, or None
+        @param clip: a list of rectangles relative to the area, 
+            out of which the surface is kept as it was
+            (The default value None means painting the whole area.)
+
+        """
+        if not self.enabled or RecordingSurface is None:
+            return _surface_context(surface, slot, width, height, clip)
+
+        recording = RecordingSurface(cairo.CONTENT_COLOR_ALPHA, 
+                (0, 0, width, height))
+        self.jobs.append((surface, slot, width, height, clip, recording))
+        cr = cairo.Context(recording)
+        if clip is not None:
+            for rect in clip:
+                cr.rectangle(*rect)
+            cr.clip()
+
+        return cr
+
+    def take(self):
+        """Return the recordings taken since the last call."""
+        jobs = self.jobs
+        self.jobs = []
+        return jobs
+
+# The queue used by all nodes
+raster_queue = RasterQueue()
+
+class SpriteCache(object):
+    """Rasters shared by nodes with the same class, size and state.
+    
+    See Node.use_sprite() and pnode.animation.
+
+    """
+    def __init__(self):
+        self.sprites = {}
+        self.stats = {'rendered': 0, 'shared': 0}
+
+    def _get(self, key, node, draw):
+        surface = self.sprites.get(key)
+        if surface is None:
+            width, height = int(node.width), int(node.height)
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            draw(raster_queue.create_context(surface, None, width, height))
+            self.sprites[key] = surface
+            self.stats['rendered'] += 1
+        else:
+            self.stats['shared'] += 1
+
+        return surface
+
+    def get(self, node):
+        """Return the raster of the node, draw it if not cached."""
+        key = (node.__class__, node.width, node.height, node.sprite_state())
+        return self._get(key, node, node.on_update)
+
+    def get_frame(self, node, func, frames, index):
+        """Return the raster of a frame of the animation function.
+        
+        @param func: the function decorated by pnode.animation
+        @param frames: the number of frames of the animation
+        @param index: the index of the frame, 
+            which is drawn at the phase index / frames
+
+        """
+        key = (node.__class__, node.width, node.height, func, frames, index)
+        phase = float(index) / frames
+        return self._get(key, node, lambda cr: func(node, cr, phase))
+
+    def clear(self):
+        """Forget all rasters (eg. after the size of nodes changed).
+        
+        Nodes still using them are not affected until repainted.
+
+        """
+        self.sprites = {}
+
+    def report(self):
+        """Return the counts as a string."""
+        return ', '.join(['%s = %d' % (k, self.stats[k]) 
+            for k in sorted(self.stats.keys())])
+
+# The cache used by all nodes
+sprite_cache = SpriteCache()
+
+class Profiler(object):
+    """Wall time and call counts of node callbacks, per node class.
+
+    The phases are on_tick, each named action, on_update, 
+    each animation function and composite.
+    It is disabled by default. 
+
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        """Forget all records."""
+        self.records = {}   # (class name, phase) -> [calls, seconds]
+
+    def add(self, node, phase, start):
+        """Record a call started at the time start."""
+        elapsed = time() - start
+        key = (node.__class__.__name__, phase)
+        record = self.records.get(key)
+        if record is None:
+            self.records[key] = [1, elapsed]
+        else:
+            record[0] += 1
+            record[1] += elapsed
+
+    def report(self, limit=None):
+        """Return a table of records sorted by the total time.
+
+        @param limit: the max number of rows (None for all)
+
+        """
+        rows = sorted(self.records.iteritems(), 
+                key=lambda item: item[1][1], reverse=True)
+        lines = ['%-16s %-24s %8s %10s %10s' % (
+            'class', 'phase', 'calls', 'total(ms)', 'avg(us)')]
+        for (name, phase), (calls, seconds) in rows[:limit]:
+            lines.append('%-16s %-24s %8d %10.2f %10.1f' % (
+                name, phase, calls, seconds * 1000, seconds * 1e6 / calls))
+
+        return '\n'.join(lines)
+
+# The profiler used by all nodes
+profiler = Profiler()
+
+def paint_display_item(cr, item):
+    """Paint a display item returned by Node.get_display_item()."""
+    surface, slot, width, height, x, y, matrix, alpha, serial, bbox = item
+    if matrix is None:
+        if slot is None:
+            cr.set_source_surface(surface, x, y)
+            cr.paint_with_alpha(alpha)
+            return
+
+        cr.save()
+    else:
+        cr.save()
+        cr.transform(matrix)
+
+    if slot is None:
+        cr.set_source_surface(surface, x, y)
+    else:
+        cr.rectangle(x, y, width, height)
+        cr.clip()
+        cr.set_source_surface(surface, x - slot[0], y - slot[1])
+
+    cr.paint_with_alpha(alpha)
+    cr.restore()
+
+class RenderWorker(object):
+    """Render frames in a thread, into two buffers taking turns.
+
+    The main thread updates nodes with pnode.raster_queue enabled, 
+    so on_update() and animations are only recorded (they read 
+    the live state of nodes). It hands over the recordings 
+    and the display list of the frame (see Node.get_display_list()).
+    While the worker is replaying the recordings into the surfaces 
+    of nodes and compositing them into the back buffer, 
+    the main thread could go on with the next tick.
+    The buffers are swapped when the frame is done, 
+    and the front buffer is copied to the window on expose.
+
+    Surfaces in the frame must not be changed until 
+    the frame is done, so wait() before updating nodes.
+
+    """
+    # Surfaces of nodes are painted by this worker (see RasterQueue)
+    rasterizes = True
+
+    def __init__(self, width, height):
+        self.cond = Condition()
+        self.lock = Lock()          # for swapping the buffers
+        self.frame = None           # (display list, clip, rasters)
+        self.busy = False
+        self.done = []              # the damage of frames done
+        self.done_all = False
+        self.last_clip = None       # the damage painted in the front buffer
+        self.cost = 0.0             # the time spent on the last frame
+        self.front = None
+        self.back = None
+        self.resize(width, height)
+
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def resize(self, width, height):
+        """Re-create both buffers (they will be fully repainted)."""
+        self.wait()
+        self.front = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self.back = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self.last_clip = None
+
+    def submit(self, display_list, clip, rasters=()):
+        """Start painting a frame.
+
+        @param clip: a list of rectangles changed in this frame 
+            (None for all)
+        @param rasters: the recordings to be replayed 
+            before compositing (see RasterQueue.take())
+
+        """
+        with self.cond:
+            self.frame = (display_list, clip, rasters)
+            self.busy = True
+            self.cond.notify()
+
+    def wait(self):
+        """Wait until the frame submitted is done."""
+        with self.cond:
+            while self.busy:
+                self.cond.wait()
+
+    def take_done(self):
+        """Return the damage of frames done since the last call 
+        (None for all, empty if no frame is done)."""
+        with self.cond:
+            rects = None if self.done_all else self.done
+            self.done = []
+            self.done_all = False
+            return rects
+
+    def run(self):
+        """The main loop of the worker thread."""
+        while True:
+            with self.cond:
+                while self.frame is None:
+                    self.cond.wait()
+
+                display_list, clip, rasters = self.frame
+                self.frame = None
+
+            start = time()
+            for job in rasters:
+                rasterize(job)
+            self.paint(display_list, clip)
+            cost = time() - start
+
+            with self.cond:
+                self.cost = cost
+                self.busy = False
+                if clip is None:
+                    self.done_all = True
+                else:
+                    self.done.extend(clip)
+
+                self.cond.notify_all()
+
+    def paint(self, display_list, clip):
+        """Paint the frame into the back buffer, then swap the buffers."""
+        # The back buffer has missed the last frame as well
+        if clip is not None and self.last_clip is not None:
+            paint_clip = merge_rects(clip + self.last_clip)
+        else:
+            paint_clip = None
+
+        cr = cairo.Context(self.back)
+        if paint_clip is not None:
+            for rect in paint_clip:
+                cr.rectangle(*rect)
+            cr.clip()
+
+        cr.set_operator(cairo.OPERATOR_CLEAR)
+        cr.paint()
+        cr.set_operator(cairo.OPERATOR_OVER)
+
+        for item in display_list:
+            if paint_clip is not None:
+                bbox = item[-1]
+                for rect in paint_clip:
+                    if rect_intersects(rect, bbox):
+                        break
+                else:
+                    continue
+
+            paint_display_item(cr, item)
+
+        with self.lock:
+            self.front, self.back = self.back, self.front
+            self.last_clip = clip
+
+    def blit(self, cr):
+        """Copy the last frame done to the context."""
+        with self.lock:
+            cr.set_source_surface(self.front, 0, 0)
+            cr.paint()
 
 class Node(object):
     """The basic element in the pnode framework."""
@@ -132,11 +1077,39 @@ class Node(object):
         @param style: the dictionary listing the style
 
         """
-        self.children = []
+        self.children = NodeList()
         self.parent = parent
+        self.surface = None
+        self.surface_slot = None
+        self.surface_shared = False
+        self.surface_x = 0
+        self.surface_y = 0
+        self.surface_serial = 0
+        # The layer this node is baked into (see damage())
+        self.layer = None
+        # For damage tracking
+        self.damaged = True
+        self.painted_bbox = None
+        self.lost_damage = []
+        # The sub-nodes with damage to report (see notify_damage())
+        self.damage_path = None
+        # The absolute position when the damage was collected
+        self.damage_origin = None
+        # For drawing order
+        self.z_index = 0
+        self.render_z = 0
+        self.render_seq = 0
+        self.render_order = None
+        # For actions
+        self.scheduler = None
+        # The offset to the interpolated position (see set_lag())
+        self.lag_x = 0
+        self.lag_y = 0
+
         self.set_style(style)
         #self.reset_surface()
 
+        self.surface_changed = Node.SURFACE_CHANGED
         self.reset_transforms()
 
         self.reset_actions()
@@ -147,13 +1120,61 @@ class Node(object):
     def set_style(self, style):
         """Set to a new style.
         
-        The new style will be evaluated immediatley.
+        The new style will be compiled and evaluated immediatley
+        (see pnode.compile_style()).
 
         @param style: the dictionary listing the style
 
         """
         self.style = style
-        evaluate_style(self, style)
+        self.compiled_style = compile_style(style)
+        z_index = self.z_index
+        self.compiled_style(self)
+        self.layout_size = (self.parent.width, self.parent.height)
+        self.damage()
+        if self.z_index != z_index and self.render_order:
+            self.render_order.update(self)
+
+    def set_geometry(self, x, y, width, height, z_index):
+        """Place the node without a style.
+        
+        It is the fast path for nodes placed by their parent,
+        e.g. objects in uicomponents.MapContainer. 
+        The position and size are kept on resize, 
+        so the parent should place the node again.
+
+        """
+        self.style = None
+        self.compiled_style = None
+        old_z_index = self.z_index
+        resized = width != self.width or height != self.height
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.z_index = z_index
+        self.layout_size = (self.parent.width, self.parent.height)
+        if resized:
+            # The surface is re-created in the next update
+            self.repaint()
+        else:
+            self.damage()
+        if z_index != old_z_index and self.render_order:
+            self.render_order.update(self)
+
+    def get_style(self):
+        """Return the style, or the equivalent of the geometry 
+        if it is placed by set_geometry()."""
+        if self.style is not None:
+            return self.style
+
+        return {
+                'left': self.x,
+                'top': self.y,
+                'width': self.width,
+                'height': self.height,
+                'z-index': self.z_index
+                }
 
     #
     # Functions for manipulating surface
@@ -169,8 +1190,13 @@ class Node(object):
         @param width: the real width
         @param height: the real height
 
+        The surface is taken from pnode.surface_pool, 
+        and the old one is given back to it.
+
         """
-        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width), int(height))
+        self._release_surface()
+        self.surface, self.surface_slot = \
+                surface_pool.acquire(int(width), int(height))
         self.surface_x = x
         self.surface_y = y
         self.surface_width = width
@@ -178,63 +1204,80 @@ class Node(object):
 
     def reset_surface(self):
         """Re-create the surface using current real position and size."""
-        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(self.width), int(self.height))
+        self.create_surface(0, 0, self.width, self.height)
+
+    def _release_surface(self):
+        if self.surface is not None:
+            if not self.surface_shared:
+                surface_pool.release(self.surface, self.surface_slot)
+            self.surface = None
+            self.surface_slot = None
+            self.surface_shared = False
+
+    def free_surface(self):
+        """Give back the surface to the pool.
+        
+        The node is repainted with a new surface in the next update.
+
+        """
+        if self.surface is not None:
+            self._release_surface()
+            self.repaint()
+
+    def use_sprite(self):
+        """Use the shared raster in pnode.sprite_cache as the surface.
+
+        The raster is drawn by on_update() of the first node 
+        with the same class, size and sprite_state().
+
+        """
+        self.share_surface(sprite_cache.get(self))
+
+    def share_surface(self, surface):
+        """Use a surface shared with other nodes.
+        
+        The surface should have the same size with this node,
+        and it is not given back to the pool.
+
+        """
+        if surface is self.surface:
+            return
+
+        self._release_surface()
+        self.surface = surface
+        self.surface_shared = True
+        # Shared rasters never change
+        self.surface_serial = 0
         self.surface_x = 0
         self.surface_y = 0
         self.surface_width = self.width
         self.surface_height = self.height
 
-    def create_surface_by_scale(self, sx, sy, rel_origin=(0.5, 0.5)):
-        """Re-create the surface for scaling.
+    def create_context(self, clip=None):
+        """Create a cleared cairo context of it's surface.
         
-        @param sx: the scale factor on x
-        @param sy: the scale factor on y
-        @param rel_origin: a list of two float number 
-            indicating the relative center 
-            (eg. (0.5, 0.5) means the center of object)
+        If the surface is a slot in a shared surface, 
+        the context is moved and clipped to the slot.
+        It draws into a recording if pnode.raster_queue is enabled.
+
+        @param clip: a list of rectangles to be repainted, 
+            and the rest of the surface is kept
+            (The default value None means repainting all.)
 
         """
-        rx = rel_origin[0] * self.width
-        ry = rel_origin[1] * self.height
-        new_width = self.width * sx
-        new_height = self.height * sy
-        delta_x = rel_origin[0] * new_width
-        delta_y = rel_origin[1] * new_height
-        self.create_surface( 
-                rx - delta_x,
-                ry - delta_y, 
-                new_width,
-                new_height
-                )
+        cr = raster_queue.create_context(self.surface, self.surface_slot, 
+                self.surface_width, self.surface_height, clip)
+        self.mark_painted()
+        return cr
 
-    def create_surface_by_rotate(self, ang, rel_origin=(0.5, 0.5)):
-        """Re-create the surface for rotation.
-        
-        @param ang: the angle
-        @param rel_origin: the same as in create_surface_by_scale()
-
-        """
-        rx = rel_origin[0] * self.width
-        ry = rel_origin[1] * self.height
-        # the corner with max length from the origin
-        mx = rel_origin[0] if rel_origin[0] > 0.5 else 1.0 - rel_origin[0]
-        my = rel_origin[1] if rel_origin[1] > 0.5 else 1.0 - rel_origin[1]
-        mlen = sqrt((self.width * mx) ** 2 + (self.height * my) ** 2)
-        new_width = mlen * 2
-        new_height = mlen * 2
-        delta_x = 0.5 * new_width
-        delta_y = 0.5 * new_height
-        self.create_surface( 
-                rx - delta_x,
-                ry - delta_y, 
-                new_width,
-                new_height
-                )
-
-    def create_surface_by_scale_rotate(self, sx, sy, ang, 
-            scale_origin=(0.5, 0.5), ang_origin=(0.5, 0.5)):
-        # XXX: to be implemented
-        pass
+    def mark_painted(self):
+        """Record that the content of its own surface is changing.
+
+        Renderers keeping copies of surfaces compare the serial 
+        to know whether the copy is outdated.
+
+        """
+        self.surface_serial = next(paint_serials)
 
     def clear_context(self, cr):
         """Clean the context."""
@@ -249,13 +1292,40 @@ class Node(object):
 
     def add_node(self, node):
         """Add the node as a sub-node."""
+        if node.render_order:
+            node.render_order.remove(node)
+        if node.scheduler:
+            node.scheduler.remove(node)
+
         self.children.append(node)
         node.parent = self
+        if self.render_order:
+            self.render_order.insert(node)
+        if self.scheduler:
+            self.scheduler.insert(node)
+        # It has been damaged since it was created or removed
+        node.notify_damage()
 
     def remove_node(self, node):
         """Remove the node from sub-nodes."""
         self.children.remove(node)
+        if node.render_order:
+            node.render_order.remove(node)
+        if node.scheduler:
+            node.scheduler.remove(node)
+
         node.parent = None
+        if self.damage_path:
+            self.damage_path.discard(node)
+        # The area it covered has to be repainted
+        self.lost_damage.extend(node.take_painted_bboxes())
+        self.notify_damage()
+        # Surfaces are given back until it is added again
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            current.free_surface()
+            stack.extend(current.children)
 
     #
     # Functions for actions
@@ -268,46 +1338,86 @@ class Node(object):
         Action is used to handle parameter change according to time,
         no matter it will update the surface or not.
 
+        Actions are performed by the pnode.Scheduler of the tree.
+
         @param name: the name of this action. 
             This name is used to indentify this action in remove_action().
+        @param func: func(node, interval, phase) is called in each tick,
+            or None for a timer (only the cleanup is called after delay)
         @param duration: the duration in seconds
         @param update: should update the surface in each tick?
         @param loop: loop it?
         @param cleanup: the callback function called after the action ends
         
         """
-
-        self.action_list[name] = {
-            'func': func,
-            'duration': float(duration),
-            'delay': float(delay),
-            'update': bool(update),
-            'loop': bool(loop),
-            'cleanup': cleanup,
-            'elapsed': 0.0,
-            'started': False
-        }
+        self.remove_action(name)
+        record = ActionRecord(self, name, func, duration, delay, 
+                update, loop, cleanup)
+        self.action_list[name] = record
+        if self.scheduler:
+            self.scheduler.add(record)
 
     def remove_action(self, name):
         """Remove the specified action."""
-        if name in self.action_list:
-            del self.action_list[name]
+        record = self.action_list.pop(name, None)
+        if record and self.scheduler:
+            self.scheduler.discard(record)
 
     def reset_actions(self):
         """Remove all actions."""
+        if self.scheduler and self.action_list:
+            for record in self.action_list.itervalues():
+                self.scheduler.discard(record)
+
         self.action_list = {}
         self.action_need_update = False
 
     def repaint(self):
         """Mark this node to update it's surface in the next tick."""
         self.action_need_update = True
+        self.damage()
+
+    def damage(self):
+        """Mark the area covered by this node to be repainted.
+
+        If this node has been baked into a layer 
+        (which draws it on behalf of this node), 
+        it is taken out from the layer to be drawn by itself again.
+        The layer should provide unbake(node).
+
+        """
+        self.damaged = True
+        self.notify_damage()
+        if self.layer is not None:
+            self.layer.unbake(self)
+
+    def notify_damage(self):
+        """Tell the parent nodes that this node has damage to report.
+
+        Call it after changing the node or lost_damage 
+        without damage(), e.g. when the surface is updated.
+        collect_damage() visits only the nodes notified.
+
+        """
+        node, parent = self, self.parent
+        # The parent of the top node is the game
+        while isinstance(parent, Node):
+            if parent.damage_path is None:
+                parent.damage_path = set()
+            elif node in parent.damage_path:
+                # The rest of the path has been notified
+                return
+
+            parent.damage_path.add(node)
+            node, parent = parent, parent.parent
 
     #
     # Functions for animations
     #
 
     def set_animation(self, func, 
-            duration=0.0, delay=0.0, loop=False, cleanup=None, pend=False):
+            duration=0.0, delay=0.0, loop=False, cleanup=None, pend=False,
+            frames=0):
         """Set the animation of this node.
         
         Basically, animation is the same with action, 
@@ -319,67 +1429,120 @@ class Node(object):
         @param pend: add the animation to the last. 
             It will be evaluated after all other animation being expired.
             (The default value False will cause deleting all other animation.)
+        @param frames: the number of cached frames (see pnode.animation)
 
         """
 
-        anime = {
-                'func': func,
-                'duration': float(duration),
-                'delay': float(delay),
-                'loop': bool(loop),
-                'cleanup': cleanup,
-                'elapsed': 0.0,
-                'started': False
-                } 
+        anime = ActionRecord(self, None, func, duration, delay, 
+                loop=loop, cleanup=cleanup, frames=frames)
 
         if pend:
             self.animation_list.append(anime)
         else:
             self.animation_list = [ anime ]
 
+        self.damage()
+
     def reset_animations(self):
         """Remove all animation."""
         self.animation_list = []
 
+    def get_animation_phase(self):
+        """Return the phase of the current animation, 
+        or None if no animation has started.
+        
+        """
+        if self.animation_list and self.animation_list[0].started:
+            anime = self.animation_list[0]
+            return anime.elapsed / anime.duration
+
+        return None
+
     #
     # Functions for transforms
     #
     
+    # Transforms are applied when the surface is composited,
+    # so the surface itself is never transformed.
+    # SURFACE_SCALE and SURFACE_ROTATE mark the transforms in use.
     SURFACE_CREATED = 0
     SURFACE_CHANGED = 1 << 0
     SURFACE_SCALE   = 1 << 1
     SURFACE_ROTATE  = 1 << 2
+    SURFACE_TRANSFORMED = SURFACE_SCALE | SURFACE_ROTATE
 
     def reset_transforms(self):
         """Reset the transformation to the initial state."""
         self.set_alpha()
         self.set_translation()
-        self.surface_changed = Node.SURFACE_CHANGED
+        self.sx, self.sy, self.scale_origin = 1.0, 1.0, (0.5, 0.5)
+        self.ang, self.rotate_origin = 0.0, (0.5, 0.5)
+        # The surface is still valid
+        self.surface_changed &= Node.SURFACE_CHANGED
     
     def set_scale(self, sx=1.0, sy=1.0, rel_origin=(0.5, 0.5)):
         """Scale the node.
         
-        Parameters are the same with create_surface_by_scale().
+        @param sx: the scale factor on x
+        @param sy: the scale factor on y
+        @param rel_origin: a list of two float number 
+            indicating the relative center 
+            (eg. (0.5, 0.5) means the center of object)
 
         """
         self.sx = sx
         self.sy = sy
         self.scale_origin=rel_origin
-        self.surface_changed |= Node.SURFACE_SCALE | Node.SURFACE_CHANGED
+        self.surface_changed |= Node.SURFACE_SCALE
+        self.damage()
 
     def set_rotate(self, ang=0.0, rel_origin=(0.5, 0.5)):
         """Rotate the node.
         
-        Parameters are the same with create_surface_by_rotate().
+        @param ang: the angle
+        @param rel_origin: the same as in set_scale()
 
         """
         self.ang=ang
         self.rotate_origin=rel_origin
-        self.surface_changed |= Node.SURFACE_ROTATE | Node.SURFACE_CHANGED
+        self.surface_changed |= Node.SURFACE_ROTATE
+        self.damage()
+
+    def get_matrix(self, x, y):
+        """Return the matrix transforming the surface 
+        to the absolute position.
+
+        The node is scaled, then rotated, then translated.
+
+        @param x: the absolute position of this node on x
+        @param y: the absolute position of this node on y
+        @rtype: cairo.Matrix
+
+        """
+        m = cairo.Matrix(1, 0, 0, 1, 
+                x + self.surface_x + self.dx + self.lag_x, 
+                y + self.surface_y + self.dy + self.lag_y)
+        state = self.surface_changed
+        if state & Node.SURFACE_ROTATE:
+            ox = self.rotate_origin[0] * self.width
+            oy = self.rotate_origin[1] * self.height
+            m.translate(ox, oy)
+            m.rotate(self.ang)
+            m.translate(-ox, -oy)
+
+        if state & Node.SURFACE_SCALE:
+            ox = self.scale_origin[0] * self.width
+            oy = self.scale_origin[1] * self.height
+            m.translate(ox, oy)
+            m.scale(self.sx, self.sy)
+            m.translate(-ox, -oy)
+
+        return m
 
     def set_alpha(self, alpha=1.0):
         """Set the opacity of the node."""
         self.alpha=alpha
+        self.damage()
 
     def set_translation(self, dx=0.0, dy=0.0):
         """Set the translation of the node.
@@ -393,29 +1556,71 @@ class Node(object):
         """
         self.dx = dx
         self.dy = dy
+        self.damage()
+
+    def set_lag(self, lag_x=0, lag_y=0):
+        """Set the offset from the logical position to the drawn position.
+
+        Used by the fixed-step simulation to draw moving nodes 
+        between their last two simulated positions.
+
+        """
+        if lag_x != self.lag_x or lag_y != self.lag_y:
+            self.lag_x = lag_x
+            self.lag_y = lag_y
+            self.damage()
 
     #
     # Functions to be overwritten in sub-classes
     #
     
+    # Set it to true in sub-classes whose on_update() depends only on 
+    # the size and sprite_state(), to share the raster between nodes.
+    cache_sprite = False
+
     def on_update(self, cr):
         """Overload this method to implement static graphics of this node."""
         pass
 
+    def sprite_state(self):
+        """Overload this method to return the (hashable) state 
+        that on_update() depends on, besides the class and size.
+        
+        """
+        return None
+
     def on_resize(self):
         """Overload this method to implement customized resizing.
         
+        It is called only if the size of the parent node has changed
+        since the last layout (see do_resize_recursive()).
         Remember to call the original on_resize() in an overloading method.
 
         """
-        evaluate_style(self, self.style)
-        self.reset_surface()
-        self.repaint()
+        if self.compiled_style:
+            self.compiled_style(self)
+        self.layout_size = (self.parent.width, self.parent.height)
+        if (self.surface is None or self.surface_width != self.width 
+                or self.surface_height != self.height):
+            # The surface is re-created in the next update
+            self.repaint()
+        else:
+            self.damage()
 
     def on_tick(self, interval):
         """Overload this method to do things in each tick."""
         pass
 
+    def on_interpolate(self, alpha):
+        """Overload this method to place nodes between two ticks.
+
+        It is called before drawing in the fixed-step mode of Game.
+
+        @param alpha: the elapsed part of the next tick (from 0 to 1)
+
+        """
+        pass
+
     #
     # Core functions
     #
@@ -424,65 +1629,61 @@ class Node(object):
         """Update the surface."""
         # Use the first animation
         anime = self.animation_list[0]
-        if not anime['started']:
-            anime['delay'] -= interval
-            if anime['delay'] <= 0.0:
-                anime['started'] = True
+        if not anime.started:
+            anime.delay -= interval
+            if anime.delay <= 0.0:
+                anime.started = True
 
         else:
             # Check it's life
-            anime['elapsed'] += interval
-            if anime['elapsed'] > anime['duration']:
-                if anime['loop']:
+            anime.elapsed += interval
+            if anime.elapsed > anime.duration:
+                if anime.loop:
                     # XXX: if duration is too small?
-                    anime['elapsed'] -= anime['duration']
+                    anime.elapsed -= anime.duration
                 else:
-                    if anime['cleanup']: anime['cleanup']()
+                    if anime.cleanup: anime.cleanup()
                     self.animation_list.pop(0)
                     return
 
-            phase = anime['elapsed'] / anime['duration']
-            # Obtain the context
-            cr = self._get_context()
-            # Perform this animation
-            anime['func'](self, cr, phase)
+            phase = anime.elapsed / anime.duration
+            frames = anime.frames
+            profiling = profiler.enabled
+            if profiling:
+                start = time()
+
+            if frames:
+                # Replay the cached frame
+                index = int(phase * frames) % frames
+                self.share_surface(
+                        sprite_cache.get_frame(self, anime.func, 
+                            frames, index))
+            else:
+                # Obtain the context
+                cr = self._get_context()
+                # Perform this animation
+                anime.func(self, cr, phase)
+
+            if profiling:
+                profiler.add(self, ('cached animation ' if frames 
+                    else 'animation ') + anime.func.__name__, start)
             self._updated = True
 
     def _get_context(self):
-        """Get the adjusted cairo context of it's surface.
-            1. Re-create the surface as needed.
-            2. Push the transformation matrix to the context.
-            3. Return this modified context.
+        """Get the cleared cairo context of it's surface.
 
-        """
-        state = self.surface_changed
-        if state & Node.SURFACE_CHANGED:
-            if state == Node.SURFACE_CHANGED:
-                self.reset_surface()
-                cr = cairo.Context(self.surface)
-            elif state & Node.SURFACE_SCALE and state & Node.SURFACE_ROTATE:
-                # XXX: to be implemented
-                self.create_surface_by_scale_rotate()
-            elif state & Node.SURFACE_SCALE:
-                self.create_surface_by_scale(self.sx, self.sy, 
-                        self.scale_origin)
-                cr = cairo.Context(self.surface)
-                cr.scale(self.sx, self.sy)
-                self.clear_context(cr)
-            elif state & Node.SURFACE_ROTATE:
-                self.create_surface_by_rotate(self.ang, self.rotate_origin)
-                cr = cairo.Context(self.surface)
-                delta = self.surface_width * 0.5
-                cr.translate(delta, delta)
-                cr.rotate(self.ang)
-                cr.translate(-delta, -delta)
-                cr.translate(-self.surface_x, -self.surface_y)
-                self.clear_context(cr)
-        else:
-            cr = cairo.Context(self.surface)
-            self.clear_context(cr)
+        The surface is re-created if it has been changed, 
+        resized, or shared with other nodes.
 
-        return cr
+        """
+        if (self.surface_changed & Node.SURFACE_CHANGED 
+                or self.surface is None or self.surface_shared
+                or self.surface_width != self.width 
+                or self.surface_height != self.height):
+            self.reset_surface()
+            self.surface_changed &= ~Node.SURFACE_CHANGED
+
+        return self.create_context()
         
     def do_update(self, interval):
         """Update the surface of this node."""
@@ -494,103 +1695,377 @@ class Node(object):
         # If marked as "need to update",
         # and not being updated using animation,
         # update it using the static on_update() method.
-        if self.action_need_update and not self._updated:
-            cr = self._get_context()
-            self.on_update(cr)
+        if ((self.action_need_update or self.surface is None) 
+                and not self._updated):
+            profiling = profiler.enabled
+            if profiling:
+                start = time()
+
+            if self.cache_sprite:
+                self.use_sprite()
+            else:
+                cr = self._get_context()
+                self.on_update(cr)
+
+            if profiling:
+                profiler.add(self, 'on_update', start)
             self.action_need_update = False
 
-    def do_update_recursive(self, cr, x, y, interval):
-        """Update this node and all sub-nodes."""
-        stack = [(self, x, y, self.z_index)]
-        queue = []
+        if self.animation_list:
+            # Painted again in the next frame
+            self.notify_damage()
+
+    #
+    # Functions for damage tracking
+    #
+
+    def get_bbox(self, x, y):
+        """Return the area that this node will cover in the next frame.
+
+        @param x: the absolute position of this node on x
+        @param y: the absolute position of this node on y
+        @return: (x, y, width, height)
+
+        """
+        if not self.surface_changed & Node.SURFACE_TRANSFORMED:
+            return (x + self.surface_x + self.dx + self.lag_x, 
+                    y + self.surface_y + self.dy + self.lag_y, 
+                    self.width, self.height)
+
+        m = self.get_matrix(x, y)
+        w, h = self.width, self.height
+        points = [m.transform_point(px, py) 
+                for px, py in ((0, 0), (w, 0), (0, h), (w, h))]
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        return (min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+
+    def take_painted_bboxes(self):
+        """Collect the painted areas of this node and all sub-nodes.
+        
+        Used when the node leaves the tree. 
+        The areas are forgotten, so they are reported only once.
+
+        @return: a list of rectangles
+
+        """
+        rects = []
+        stack = [self]
+        while stack:
+            current = stack.pop()
+            if current.painted_bbox:
+                rects.append(current.painted_bbox)
+                current.painted_bbox = None
+
+            rects.extend(current.lost_damage)
+            current.lost_damage = []
+            current.damaged = True
+            # Check all sub-nodes when it joins a tree again
+            current.damage_origin = None
+            stack.extend(current.children)
+
+        return rects
 
-        # Create the list of nodes
+    def collect_damage(self, x, y):
+        """Collect the areas to be repainted in this node and all sub-nodes.
+
+        A node is damaged if it has been moved, transformed, 
+        or it's surface is going to be updated.
+        Both the old and the new area of a damaged node are reported.
+
+        Only nodes on the paths notified by notify_damage() are visited, 
+        plus all sub-nodes of a node whose absolute position changed.
+
+        @param x: the absolute position of the parent on x
+        @param y: the absolute position of the parent on y
+        @return: a list of rectangles
+
+        """
+        rects = []
+        stack = [(self, x, y, False)]
         while stack:
-            current, x, y, z = stack.pop(0)
-            # The position (x, y, z-index) is inherited from the parent node.
+            current, x, y, moved = stack.pop()
             node_x = x + current.x
             node_y = y + current.y
-            z_index = z + current.z_index
-            queue.append((current, node_x, node_y, z_index))
-            stack = [(node, node_x, node_y, z_index) \
-                    for node in current.children] + stack
+            # Baked nodes are reported by their layer
+            if current.layer is None:
+                bbox = current.get_bbox(node_x, node_y)
+                if (current.damaged or current.action_need_update 
+                        or current.animation_list 
+                        or bbox != current.painted_bbox):
+                    if current.painted_bbox:
+                        rects.append(current.painted_bbox)
+                    rects.append(bbox)
+                    current.damaged = False
+
+            if current.lost_damage:
+                rects.extend(current.lost_damage)
+                current.lost_damage = []
+
+            path = current.damage_path
+            current.damage_path = None
+            if moved or current.damage_origin != (node_x, node_y):
+                # All sub-nodes have been moved
+                current.damage_origin = (node_x, node_y)
+                stack.extend([(node, node_x, node_y, True) 
+                    for node in current.children])
+            elif path:
+                stack.extend([(node, node_x, node_y, False) 
+                    for node in path if node.parent is current])
+
+        return rects
+
+    @traced('Node.do_update_recursive')
+    def do_update_recursive(self, cr, x, y, interval, clip=None):
+        """Update this node and all sub-nodes.
+
+        Nodes are drawn in the order kept by pnode.RenderOrder,
+        which is created for this node at the first call.
+        
+        @param clip: a list of rectangles to be repainted. 
+            Nodes outside these rectangles are updated but not painted.
+            (The default value None means painting all nodes.)
 
-        # Sort by z-index
-        queue.sort(key=lambda tup: -tup[3])
+        """
+        profiling = profiler.enabled
+        for current, node_x, node_y in self.iter_updated(x, y, interval, clip):
+            if profiling:
+                start = time()
+                current.composite(cr, node_x, node_y)
+                profiler.add(current, 'composite', start)
+            else:
+                current.composite(cr, node_x, node_y)
 
-        while queue:
-            current, x, y, z = queue.pop(0)
-            current.do_update(interval)
-            abs_x = x + current.surface_x + current.dx
-            abs_y = y + current.surface_y + current.dy
-            cr.set_source_surface(current.surface, abs_x, abs_y)
-            cr.paint_with_alpha(current.alpha)
+    @traced('Node.get_display_list')
+    def get_display_list(self, x, y, interval):
+        """Update this node and all sub-nodes like do_update_recursive(), 
+        but return what to paint instead of painting.
 
-    def do_tick(self, interval):
-        """Perform actions and on_tick() method of this node."""
-        self.on_tick(interval)
-        # Loop over all actions
-        tmp_list = self.action_list.copy()
-        for name, action in tmp_list.iteritems():
-            if not action['started']:
-                action['delay'] -= interval
-                if action['delay'] <= 0.0:
-                    action['started'] = True
+        @return: a list of display items (see get_display_item())
+
+        """
+        return [current.get_display_item(node_x, node_y) 
+                for current, node_x, node_y 
+                in self.iter_updated(x, y, interval)]
+
+    def iter_updated(self, x, y, interval, clip=None):
+        """Update this node and all sub-nodes in the drawing order.
+
+        @return: an iterator of (node, x, y) to be painted 
+            at the absolute position (x, y)
 
+        """
+        if self.render_order is None:
+            RenderOrder(self)
+
+        # Take a snapshot, since nodes may be removed during the update
+        order = self.render_order
+        for current in order.snapshot():
+            if current.render_order is not order:
+                # Removed by another node
+                continue
+
+            if current.layer is not None:
+                # Drawn by the layer
+                continue
+
+            # The position is inherited from the parent nodes.
+            node_x, node_y = x, y
+            node = current
+            while True:
+                node_x += node.x
+                node_y += node.y
+                if node is self:
+                    break
+                node = node.parent
+
+            if tracer.enabled:
+                start = time()
+                current.do_update(interval)
+                if time() - start > tracer.threshold:
+                    tracer.add(current.__class__.__name__ + '.do_update', 
+                            start)
             else:
-                # Check it's life
-                action['elapsed'] += interval
-                if action['elapsed'] > action['duration']:
-                    if action['loop']:
-                        # XXX: if duration is too small?
-                        action['elapsed'] -= action['duration']
-                    else:
-                        if action['cleanup']: action['cleanup']()
-                        del self.action_list[name]
-                        continue
-
-                phase = 0.0 if action['duration'] <= 0.0 \
-                            else action['elapsed'] / action['duration']
-                # Perform the action
-                action['func'](self, interval, phase)
-                if action['update']:
-                    # Mark as "need to update".
-                    # It is cleaned in do_update_recursive().
-                    self.action_need_update = True
+                current.do_update(interval)
+
+            if current.surface is None:
+                # Removed by itself
+                continue
+
+            bbox = current.get_bbox(node_x, node_y)
+            current.painted_bbox = bbox
+            if clip is not None:
+                for rect in clip:
+                    if rect_intersects(rect, bbox):
+                        break
+                else:
+                    continue
+
+            yield current, node_x, node_y
 
+    def composite(self, cr, x, y):
+        """Paint the surface of this node to the context,
+        applying the translation, scale, rotation and opacity.
+        
+        @param x: the absolute position of this node on x
+        @param y: the absolute position of this node on y
+
+        """
+        paint_display_item(cr, self.get_display_item(x, y))
+
+    def get_display_item(self, x, y):
+        """Return everything needed to paint this node as a tuple.
+        
+        The tuple does not refer to the node, 
+        so it could be painted while the node is changing.
+
+        @return: (surface, slot, width, height, x, y, matrix, alpha, 
+            serial, bbox), where matrix is None if the node is not 
+            transformed, and serial is the surface_serial
+        
+        """
+        if not self.surface_changed & Node.SURFACE_TRANSFORMED:
+            matrix = None
+            x += self.surface_x + self.dx + self.lag_x
+            y += self.surface_y + self.dy + self.lag_y
+        else:
+            matrix = self.get_matrix(x, y)
+            x, y = 0, 0
+
+        return (self.surface, self.surface_slot, 
+                self.surface_width, self.surface_height, 
+                x, y, matrix, self.alpha, self.surface_serial, 
+                self.painted_bbox)
+
+    def do_tick(self, interval):
+        """Perform on_tick() method of this node.
+        
+        Actions are performed by the scheduler (see do_tick_recursive()).
+
+        """
+        if profiler.enabled:
+            start = time()
+            self.on_tick(interval)
+            profiler.add(self, 'on_tick', start)
+        else:
+            self.on_tick(interval)
+
+    @traced('Node.do_tick_recursive')
     def do_tick_recursive(self, interval):
-        """Perform do_tick() for this node and all sub-nodes."""
-        queue = [self]
-        while queue:
-            current = queue.pop(0)
-            current.do_tick(interval)
-            for node in current.children:
-                queue.append(node)
+        """Perform do_tick() for this node and all sub-nodes
+        with their own on_tick(), then the actions of them.
+        
+        The pnode.Scheduler is created for this node at the first call.
+
+        """
+        scheduler = self.scheduler
+        if scheduler is None:
+            scheduler = Scheduler(self)
+
+        ticking = scheduler.ticking
+        for node in ticking.as_list():
+            # Skip nodes removed by the previous ones
+            if node in ticking:
+                node.do_tick(interval)
+
+        scheduler.tick(interval)
+
+    def do_interpolate_recursive(self, alpha):
+        """Perform on_interpolate() for this node and all sub-nodes."""
+        stack = [self]
+        while stack:
+            current = stack.pop()
+            current.on_interpolate(alpha)
+            stack.extend(current.children)
+
+    def needs_layout(self):
+        """Return true if the size of the parent node has changed
+        since the last layout."""
+        parent = self.parent
+        return self.layout_size != (parent.width, parent.height)
 
     def do_resize_recursive(self):
-        """Perform on_resize() for this node and all sub-nodes."""
+        """Perform on_resize() for this node and all sub-nodes
+        that need layout (see needs_layout()).
+        
+        Parent nodes are laid out before their sub-nodes.
+
+        """
         queue = [self]
         while queue:
             current = queue.pop(0)
-            current.on_resize()
+            if current.needs_layout():
+                current.on_resize()
             for node in current.children:
                 queue.append(node)
 
 class Game(object):
     """The application class in pnode framework."""
-    def __init__(self, title, width, height, fps):
+    def __init__(self, title, width, height, fps, damage_tracking=True, 
+            sim_hz=0, max_steps=5, max_skip=3, threaded=False, 
+            resize_delay=0.2):
         """Initialize the game.
         
         @param title: the title of window
         @param fps: the desired fps
+        @param damage_tracking: repaint only the area of changed nodes 
+            instead of the whole window in each frame
+        @param sim_hz: the number of ticks per second in the fixed-step mode,
+            independent of fps (The default value 0 means ticking once 
+            per frame with the elapsed time.)
+        @param max_steps: the maximum number of ticks in a frame 
+            (The time behind that is dropped.)
+        @param max_skip: the maximum number of frames in a row 
+            not drawn when drawing is slower than the frame interval 
+            (0 to draw every frame)
+        @param threaded: render frames in a worker thread 
+            (see RenderWorker)
+        @param resize_delay: the time in seconds the size of the window 
+            has to be stable before nodes are resized 
+            (The last frame is scaled to the window meanwhile.)
 
         """
         self.title = title
         self.width = width
         self.height = height
         self.timer_interval = int(1000.0/fps)
+        self.damage_tracking = damage_tracking
+        # The function returning the current time in seconds.
+        # The headless backend replaces it with its own clock.
+        self.clock = time
+        self.cur_time = 0
+        self.interval = 0
+        # For the fixed-step mode
+        self.sim_step = 1.0 / sim_hz if sim_hz else 0
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+        self.dropped_steps = 0
+        # For frame skipping
+        self.max_skip = max_skip
+        self.draw_cost = 0.0        # the time spent on the last draw
+        self.draw_interval = 0.0    # the time since the last drawn frame
+        self.skip_left = 0
+        self.skipped_frames = 0
+        self.drawn_frames = 0
+        # For the threaded rendering
+        self.render_worker = RenderWorker(width, height) \
+                if threaded else None
+        # The recorder of frame durations, 
+        # with method add(tick, draw, idle) (eg. framestats.FrameStats)
+        self.frame_stats = None
+        self.__frame_start = None
+        self.__tick_cost = 0.0
+        self.__draw_total = 0.0
 
         self.top_node = None
+        self.__painted_top_node = None
+        # For resizing (see do_resize())
+        self.resize_delay = resize_delay
+        self.pending_size = None    # allocated but not applied yet
+        self.resize_time = 0.0      # the time of the last allocation
+        self.placeholder = None     # the frame shown until it is applied
+        # The last frame drawn without a render worker (see draw())
+        self.frame_buffer = None
 
         self.__quit = False
         self.__keymap = set()
@@ -600,13 +2075,32 @@ class Game(object):
         """Quit from game."""
         self.__quit = True
 
+    def has_quit(self):
+        """Return true if quit() has been called."""
+        return self.__quit
+
+    def main_quit(self):
+        """Stop the main loop (of gtk)."""
+        gtk.main_quit()
+
+    def keyval_from_name(self, keyname):
+        """Return the key value used in the keymap.
+        
+        Without gtk, the name itself is used as the key value.
+
+        """
+        if gdk is None:
+            return keyname
+
+        return gdk.keyval_from_name(keyname)
+
     def key_up(self, keyname):
         """Return true if the specified key is released.
         
         It returns true only at the instance of releasing the key.
 
         """
-        key = gdk.keyval_from_name(keyname)
+        key = self.keyval_from_name(keyname)
         return not (key in self.__keymap) and (key in self.__next_keymap)
 
     def key_down(self, keyname):
@@ -615,9 +2109,22 @@ class Game(object):
         It returns true only at the instance of pressing the key.
 
         """
-        key = gdk.keyval_from_name(keyname)
+        key = self.keyval_from_name(keyname)
         return (key in self.__keymap) and not (key in self.__next_keymap)
 
+    def press_key(self, key):
+        """Record the key as pressed.
+        
+        @param key: the key value (see keyval_from_name())
+
+        """
+        self.__next_keymap.add(key)
+
+    def release_key(self, key):
+        """Record the key as released."""
+        if key in self.__next_keymap:
+            self.__next_keymap.remove(key)
+
     def on_tick(self, interval):
         """Overload this function to do things in each tick."""
         pass
@@ -629,40 +2136,232 @@ class Game(object):
         """
         try:
             cr = widget.window.cairo_create()
-            self.top_node.do_update_recursive(cr, 0, 0, self.interval)
+            clip = None
+            if self.damage_tracking:
+                clip = [(r.x, r.y, r.width, r.height) 
+                        for r in event.region.get_rectangles()]
+
+            self.draw(cr, clip)
         except KeyboardInterrupt:
             self.quit()
 
+    def draw(self, cr, clip=None):
+        """Draw the frame onto the context.
+        
+        @param clip: a list of rectangles to be repainted
+            (The default value None means repainting all.)
+
+        """
+        start = time()
+        if self.pending_size and self.placeholder:
+            self.draw_placeholder(cr)
+            return
+
+        if clip is not None:
+            for rect in clip:
+                cr.rectangle(*rect)
+            cr.clip()
+
+        if self.render_worker:
+            # Already painted by the worker
+            self.render_worker.blit(cr)
+        else:
+            # The frame is kept in frame_buffer (see capture_frame())
+            if self.frame_buffer is None:
+                self.frame_buffer = cairo.ImageSurface(
+                        cairo.FORMAT_ARGB32, self.width, self.height)
+                buffer_clip = None
+            else:
+                buffer_clip = clip
+
+            buffer_cr = cairo.Context(self.frame_buffer)
+            if buffer_clip is not None:
+                for rect in buffer_clip:
+                    buffer_cr.rectangle(*rect)
+                buffer_cr.clip()
+
+            buffer_cr.set_operator(cairo.OPERATOR_CLEAR)
+            buffer_cr.paint()
+            buffer_cr.set_operator(cairo.OPERATOR_OVER)
+            # Animations go on by the time of skipped frames as well
+            self.top_node.do_update_recursive(buffer_cr, 0, 0, 
+                    self.draw_interval, buffer_clip)
+            self.draw_interval = 0.0
+            self.drawn_frames += 1
+            cr.set_source_surface(self.frame_buffer, 0, 0)
+            cr.paint()
+            self.draw_cost = time() - start
+
+        self.__draw_total += time() - start
+
+    @traced('Game.do_timeout')
     def do_timeout(self):
         """The actual 'tick'."""
+        start = time()
+        self.record_frame(start)
         try:
             if self.__quit:
-                gtk.main_quit()
+                self.main_quit()
+
+            if (self.pending_size and 
+                    self.clock() - self.resize_time >= self.resize_delay):
+                self.resize(*self.pending_size)
 
             # Calculate elapsed time
-            last_time = time()
+            last_time = self.clock()
             self.interval = last_time - self.cur_time
             self.cur_time = last_time
-            # Handle time events
-            self.on_tick(self.interval)
-            # Handle time events of nodes
-            self.top_node.do_tick_recursive(self.interval)
-            # Take a snapshot of the lastest state of keymap
-            self.__keymap = self.__next_keymap.copy()
+            if self.sim_step:
+                self.do_fixed_steps()
+            else:
+                self.do_step(self.interval)
             # Handle frame update
-            self.area.queue_draw()
+            self.draw_interval += self.interval
+            if self.pending_size:
+                # The placeholder is shown until the size is applied
+                self.queue_draw(None)
+            elif self.should_skip():
+                # The damage is kept until the next drawn frame
+                self.skipped_frames += 1
+            elif self.render_worker:
+                self.render_frame()
+            else:
+                self.queue_damage()
         except KeyboardInterrupt:
             self.quit()
 
+        self.__tick_cost = time() - start
         return True
 
+    def record_frame(self, now):
+        """Pass the durations of the last frame to frame_stats.
+
+        @param now: the time the last frame ended 
+
+        """
+        if self.frame_stats and self.__frame_start is not None:
+            period = now - self.__frame_start
+            idle = period - self.__tick_cost - self.__draw_total
+            self.frame_stats.add(self.__tick_cost, self.__draw_total, 
+                    max(idle, 0.0))
+
+        self.__frame_start = now
+        self.__draw_total = 0.0
+
+    def do_step(self, interval):
+        """Advance the game by one tick."""
+        # Handle time events
+        self.on_tick(interval)
+        # Handle time events of nodes
+        self.top_node.do_tick_recursive(interval)
+        # Take a snapshot of the lastest state of keymap
+        self.__keymap = self.__next_keymap.copy()
+
+    def do_fixed_steps(self):
+        """Catch up with the elapsed time by ticks of fixed length."""
+        step = self.sim_step
+        self.accumulator += self.interval
+        steps = 0
+        while self.accumulator >= step:
+            if steps == self.max_steps:
+                # Too far behind, give up the rest
+                dropped = int(self.accumulator / step)
+                self.dropped_steps += dropped
+                self.accumulator -= dropped * step
+                break
+
+            self.do_step(step)
+            self.accumulator -= step
+            steps += 1
+
+        self.top_node.do_interpolate_recursive(self.accumulator / step)
+
+    def should_skip(self):
+        """Return true if this frame should not be drawn.
+
+        If the last draw took longer than the frame interval,
+        the following frames are skipped for the time it overran 
+        (at most max_skip frames), so that ticks keep the pace.
+
+        """
+        if self.skip_left > 0:
+            self.skip_left -= 1
+            return True
+
+        budget = self.timer_interval / 1000.0
+        if self.max_skip and self.draw_cost > budget:
+            self.skip_left = min(int(self.draw_cost / budget), 
+                    self.max_skip) - 1
+            # Count it once
+            self.draw_cost = 0.0
+            return True
+
+        return False
+
+    def take_damage(self):
+        """Return the area changed since the last frame.
+        
+        The whole window is changed if damage tracking is disabled,
+        or the top node has been switched or resized.
+
+        @return: a list of rectangles, or None for the whole window
+
+        """
+        rects = self.top_node.collect_damage(0, 0)
+        if (not self.damage_tracking 
+                or self.top_node is not self.__painted_top_node):
+            self.__painted_top_node = self.top_node
+            return None
+
+        return merge_rects(rects)
+
+    def queue_damage(self):
+        """Request repainting of the area changed since the last frame."""
+        self.queue_draw(self.take_damage())
+
+    def queue_draw(self, rects):
+        """Request repainting of the rectangles (None for all)."""
+        if rects is None:
+            self.area.queue_draw()
+            return
+
+        for rect in rects:
+            self.area.queue_draw_area(*rect)
+
+    def render_frame(self):
+        """Hand over this frame to the render worker.
+
+        Frames are shown to the window once they are done, 
+        so they are one frame behind.
+
+        """
+        worker = self.render_worker
+        worker.wait()
+        self.queue_draw(worker.take_done())
+
+        start = time()
+        clip = self.take_damage()
+        raster_queue.enabled = worker.rasterizes
+        try:
+            display_list = self.top_node.get_display_list(
+                    0, 0, self.draw_interval)
+        finally:
+            raster_queue.enabled = False
+
+        self.draw_interval = 0.0
+        self.drawn_frames += 1
+        # The updating here and the painting of the last frame
+        self.draw_cost = time() - start + worker.cost
+        worker.submit(display_list, clip, raster_queue.take())
+        # In case the worker is done already
+        self.queue_draw(worker.take_done())
+
     def do_key_press(self, widget, event):
         """The function handling key-press-event.
         
         Record the state of key.
         """
-        key = event.keyval
-        self.__next_keymap.add(key)
+        self.press_key(event.keyval)
         return True
 
     def do_key_release(self, widget, event):
@@ -670,26 +2369,82 @@ class Game(object):
         
         Record the state of key.
         """
-        key = event.keyval
-        if key in self.__next_keymap:
-            self.__next_keymap.remove(key)
-
+        self.release_key(event.keyval)
         return True
 
     def do_resize(self, widget, allocation):
         """The function handling resize in gtk framework.
         
-        Call do_resize_recursive() on top node to resize all nodes.
+        The size is applied by resize() in a tick after it has been 
+        stable for resize_delay, so dragging the window edge 
+        does not re-create surfaces for sizes shown only briefly.
+        Meanwhile the last frame is scaled as a placeholder.
 
         """
-        self.width = allocation.width
-        self.height = allocation.height
+        size = (allocation.width, allocation.height)
+        if size == (self.width, self.height):
+            if self.pending_size:
+                # Back to the current size, nothing to be re-created
+                self.pending_size = None
+                self.placeholder = None
+                self.__painted_top_node = None
+            return
+
+        if self.pending_size is None and self.top_node:
+            self.placeholder = self.capture_frame()
+        self.pending_size = size
+        self.resize_time = self.clock()
+
+    def capture_frame(self):
+        """Return an image surface of the last frame drawn, 
+        in the current size (None if no frame has been drawn).
+        
+        Nodes are not updated for it.
+
+        """
+        if not self.render_worker:
+            # It is replaced instead of being drawn again after resize()
+            return self.frame_buffer
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 
+                self.width, self.height)
+        cr = cairo.Context(surface)
+        self.render_worker.blit(cr)
+        return surface
+
+    def draw_placeholder(self, cr):
+        """Scale the placeholder to the allocated size."""
+        width, height = self.pending_size
+        cr.save()
+        cr.scale(float(width) / self.width, float(height) / self.height)
+        cr.set_source_surface(self.placeholder, 0, 0)
+        cr.paint()
+        cr.restore()
+
+    def resize(self, width, height):
+        """Resize the game and all nodes.
+        
+        Call do_resize_recursive() on top node to lay out 
+        the nodes affected.
+
+        """
+        self.pending_size = None
+        self.placeholder = None
+        self.frame_buffer = None
+        self.width = width
+        self.height = height
+        if self.render_worker:
+            self.render_worker.resize(width, height)
         self.top_node.do_resize_recursive()
+        # Force repainting the whole window
+        self.__painted_top_node = None
 
     def run(self):
         """The main loop of the game."""
-        self.cur_time = time()
+        self.cur_time = self.clock()
         self.interval = 0
+        self.accumulator = 0.0
+        self.draw_interval = 0.0
 
         window = gtk.Window()
         window.connect('destroy', gtk.main_quit)
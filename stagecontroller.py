@@ -21,23 +21,28 @@ BREAKABLE       = 1 << 3
 ENEMY           = 1 << 4
 PLAYER          = 1 << 5
 BOMB            = 1 << 6
-FIRE            = 1 << 7
 DEAD            = 1 << 8
 ITEM            = 1 << 9
 BOMB_EATER      = 1 << 10
 FLYING          = 1 << 11
+TRACKING        = 1 << 12
 
 def stageobj(flag, node):
     """Set a flag of the node.
     
+    If the node is in a uicomponents.MapContainer, 
+    the flag grid of the map is updated as well.
+
     @type node: pnode.Node
     @return: the node
 
     """
-    try:
-        node.stageobj_flags |= flag
-    except AttributeError:
-        node.stageobj_flags = flag
+    old_flags = getattr(node, 'stageobj_flags', 0)
+    node.stageobj_flags = old_flags | flag
+    if node.stageobj_flags != old_flags:
+        update_flags = getattr(node.parent, 'update_flags', None)
+        if update_flags:
+            update_flags(node, old_flags)
 
     return node
 
@@ -305,34 +310,26 @@ def make_bomberai(stage, node, timeout=1.0):
     node.stop_ai = instancemethod(stop_ai, node)
     return node
 
-def make_trackingfloor(stage, node, x, y, on_enter, on_leave):
+def is_trackingfloor(node):
+    return stageobj_has_flag(TRACKING, node)
+
+def make_trackingfloor(node, on_enter, on_leave):
     """Make the node detect enter and leave event of the player.
     
     Used only by Floor object.
+    The node is not ticked. StageScene.on_tick() calls the callbacks 
+    when the cell of the player changes (see track_player()).
     
     @type node: pnode.Node
-    @type stage: stagescene.StageScene
     @param on_enter: the callback function called 
         when the player entered the same cell
     @param on_leave: the callback function called
         when the player left this cell
 
     """
-    node.entered = False
-
-    def on_tick(self, interval):
-        map = stage.map
-        player = stage.player
-        is_same_pos = ((x, y) == map.get_cell(player))
-        if is_same_pos and not self.entered:
-            self.entered = True
-            on_enter()
-        elif not is_same_pos and self.entered:
-            self.entered = False
-            on_leave()
-
-    node.on_tick = instancemethod(on_tick, node)
-    return node
+    node.on_player_enter = on_enter
+    node.on_player_leave = on_leave
+    return stageobj(TRACKING, node)
 
 #
 # fire and bomb
@@ -351,25 +348,13 @@ def make_bomb(node, delay, power, bomber, on_explode):
     """
     stageobj(BOMB, node)
 
-    node.bomb_delay = delay
     node.bomb_power = power
     node.bomber = bomber
     
-    def on_tick(self, interval):
-        self.bomb_delay -= interval
-        if self.bomb_delay < 0:
-            on_explode()
-
-    node.on_tick = instancemethod(on_tick, node)
+    # Count down by a timer (see pnode.Scheduler)
+    node.add_action('explode', None, delay=delay, cleanup=on_explode)
     return node
 
-def is_fire(node):
-    return stageobj_has_flag(FIRE, node)
-
-def fire(node):
-    """Mark the node as a fire caused by bombs."""
-    return stageobj(FIRE, node)
-
 def is_item(node):
     return stageobj_has_flag(ITEM, node)
 
@@ -388,7 +373,7 @@ def make_item(stage, node, on_eat=None):
         if on_eat: on_eat(who)
         stage.map.remove_node(self)
         stage.add_node(self)
-        style = self.style
+        style = dict(self.get_style())
         style['left'] = self.x + stage.map.x
         style['top'] = self.y + stage.map.y
         self.set_style(style)
@@ -400,7 +385,7 @@ def make_item(stage, node, on_eat=None):
             self.set_translation(0, -phase * cell_size * 3)
             self.set_rotate(phase * pi * 4)
 
-        self.add_action('eaten', _eat_action, duration=1.5, update=True)
+        self.add_action('eaten', _eat_action, duration=1.5)
 
     node.eat = instancemethod(eat, node)
 
@@ -0,0 +1,410 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""The procedural stage generator.
+
+The layout of a stage is computed in arrays first,
+without creating any node, and StageScene.build() then creates
+all objects in one pass. Maps of hundreds of cells per side
+are generated in linear time:
+
+    layout = generate((100, 100), seed=1)
+    stage.build(layout)
+
+Objects in a layout use the same characters as stagesetting
+(see StageScene.parse()), and the stages there are read by parse().
+
+This module does not need gtk or cairo.
+
+"""
+
+from array import array
+from random import Random
+from random import random as _random
+
+EMPTY = ' '
+HARD_BLOCK = 'x'
+SOFT_BLOCK = 'o'
+PLAYER = '@'
+RESERVED = '.'
+ENEMY_NORMAL = 'A'
+ENEMY_BOMBEATER = 'B'
+ENEMY_FLYING = 'C'
+ENEMY_BOMBER = 'D'
+
+# (character of enemy, weight)
+ENEMY_MIX = ((ENEMY_NORMAL, 5), (ENEMY_BOMBEATER, 3), 
+        (ENEMY_FLYING, 1), (ENEMY_BOMBER, 1))
+
+# All characters of objects in a layout
+OBJECTS = frozenset([HARD_BLOCK, SOFT_BLOCK, PLAYER, RESERVED] + 
+        [c for c, weight in ENEMY_MIX])
+
+class FreeCells(object):
+    """The cells free for objects randomly put in stage generation.
+
+    Free cells are kept in an array, and the position of each cell
+    in it is kept in another (-1 for cells taken), so a cell is
+    taken in O(1) by swapping it with the last free one.
+    Thus random sampling without replacement is also O(1).
+
+    """
+    def __init__(self, map_size, random=_random):
+        """Create the index with all cells free.
+
+        @param random: the function returning a random float in [0, 1)
+
+        """
+        self.map_size = map_size
+        self.random = random
+        n = map_size[0] * map_size[1]
+        # The index of cell (x, y) is x * map_size[1] + y
+        self.cells = array('i', xrange(0, n))
+        self.pos = array('i', xrange(0, n))
+        self.count = n
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, cell):
+        x, y = cell
+        return self.pos[x * self.map_size[1] + y] >= 0
+
+    def take(self, x, y):
+        """Take the cell out of free cells (nothing is done
+        if it is outside the map or has been taken)."""
+        if (0 <= x and x < self.map_size[0]
+                and 0 <= y and y < self.map_size[1]):
+            self.take_index(x * self.map_size[1] + y)
+
+    def take_index(self, index):
+        """Take the cell of the index out of free cells."""
+        i = self.pos[index]
+        if i < 0:
+            return
+
+        # Move the last free cell to the hole
+        self.count -= 1
+        last = self.cells[self.count]
+        self.cells[i] = last
+        self.pos[last] = i
+        self.pos[index] = -1
+
+    def sample(self):
+        """Take a random free cell.
+
+        @return: (x, y), or None if no cell is free
+
+        """
+        if self.count == 0:
+            return None
+
+        index = self.cells[int(self.random() * self.count)]
+        self.take_index(index)
+        return divmod(index, self.map_size[1])
+
+class Layout(object):
+    """The objects of a stage, one character for each cell."""
+    def __init__(self, map_size, cells, player):
+        """Create the layout.
+
+        @param cells: an array('c') indexed by x * map_size[1] + y
+        @param player: the cell of the player
+
+        """
+        self.map_size = map_size
+        self.cells = cells
+        self.player = player
+
+    def get(self, x, y):
+        """Return the character of the cell."""
+        return self.cells[x * self.map_size[1] + y]
+
+    def count(self, c):
+        """Return the number of cells with the character."""
+        return self.cells.tostring().count(c)
+
+    def objects(self):
+        """Iterate (x, y, character) of cells not empty."""
+        height = self.map_size[1]
+        for index, c in enumerate(self.cells):
+            if c != EMPTY:
+                x, y = divmod(index, height)
+                yield (x, y, c)
+
+    def to_string(self):
+        """Return the layout in the format of stagesetting."""
+        return '\n'.join([''.join([self.get(x, y)
+            for x in xrange(0, self.map_size[0])])
+            for y in xrange(0, self.map_size[1])])
+
+def parse(stage_str, map_size):
+    """Return the layout of a stage in the format of stagesetting.
+
+    Characters not used by objects are taken as empty cells.
+
+    @return: stagegen.Layout
+
+    """
+    width, height = map_size
+    cells = array('c', EMPTY) * (width * height)
+    player = None
+    rows = stage_str.strip().split('\n')
+    for y in xrange(0, height):
+        for x in xrange(0, width):
+            c = rows[y][x]
+            if c == PLAYER:
+                player = (x, y)
+            elif c not in OBJECTS:
+                continue
+            cells[x * height + y] = c
+
+    return Layout(map_size, cells, player)
+
+def put_soft_blocks(layout, count, random=_random):
+    """Put soft blocks on random empty cells of the layout.
+
+    Reserved cells are not chosen.
+
+    @param count: the number of soft blocks
+    @param random: the function returning a random float in [0, 1)
+
+    """
+    cells = layout.cells
+    free_cells = FreeCells(layout.map_size, random)
+    for index in xrange(0, len(cells)):
+        if cells[index] != EMPTY:
+            free_cells.take_index(index)
+
+    height = layout.map_size[1]
+    for i in xrange(0, count):
+        cell = free_cells.sample()
+        if cell is None:
+            break
+
+        cells[cell[0] * height + cell[1]] = SOFT_BLOCK
+
+def distances(cells, map_size, start):
+    """Return the distances in steps from start to every cell,
+    walking through cells without hard blocks.
+
+    @return: an array('i') indexed like cells (-1 for unreachable cells)
+
+    """
+    width, height = map_size
+    dist = array('i', [-1]) * (width * height)
+    start = start[0] * height + start[1]
+    dist[start] = 0
+    queue = array('i', [start])
+    head = 0
+    while head < len(queue):
+        index = queue[head]
+        head += 1
+        x, y = divmod(index, height)
+        d = dist[index] + 1
+        for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if not (0 <= nx and nx < width and 0 <= ny and ny < height):
+                continue
+            n = nx * height + ny
+            if dist[n] < 0 and cells[n] != HARD_BLOCK:
+                dist[n] = d
+                queue.append(n)
+
+    return dist
+
+def _find(parents, i):
+    """Return the root of i in the union-find forest."""
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+def put_walls(cells, map_size, density, rng):
+    """Put hard blocks between the hard blocks of the grid,
+    without cutting off any cell.
+
+    Cells with even x and even y (joints) are joined by wall cells 
+    (one coordinate odd). Walls on a random spanning tree of 
+    the joints are kept open, and the others are closed 
+    with the probability density.
+
+    @param rng: random.Random
+
+    """
+    width, height = map_size
+    # The index of joint (x, y) in the union-find forest
+    def _joint(x, y):
+        return (x / 2) * ((height + 1) / 2) + y / 2
+
+    parents = array('i', xrange(0, 
+        ((width + 1) / 2) * ((height + 1) / 2)))
+    walls = []
+    for x in xrange(0, width):
+        for y in xrange(0, height):
+            if x % 2 != y % 2:
+                walls.append((x, y))
+    rng.shuffle(walls)
+
+    for x, y in walls:
+        if x % 2:
+            a, b = (x - 1, y), (x + 1, y)
+        else:
+            a, b = (x, y - 1), (x, y + 1)
+
+        if b[0] >= width or b[1] >= height:
+            # Walls on the border joining nothing are kept open
+            continue
+
+        ra = _find(parents, _joint(*a))
+        rb = _find(parents, _joint(*b))
+        if ra != rb:
+            # On the spanning tree
+            parents[ra] = rb
+        elif rng.random() < density:
+            cells[x * height + y] = HARD_BLOCK
+
+def keep_open(map_size, player, escape, rng):
+    """Return the cells to be kept free of randomly put hard blocks.
+
+    They are the cells within escape steps from the player, 
+    and a random path from the player to the farthest corner, 
+    so the player is never shut in a few cells.
+
+    @param rng: random.Random
+    @return: an array('b') indexed like cells (1 for cells kept open)
+
+    """
+    width, height = map_size
+    px, py = player
+    keep = array('b', [0]) * (width * height)
+    for x in xrange(max(px - escape, 0), min(px + escape + 1, width)):
+        rest = escape - abs(x - px)
+        for y in xrange(max(py - rest, 0), min(py + rest + 1, height)):
+            keep[x * height + y] = 1
+
+    # Walk to the corner, taking a random axis in each step
+    tx = 0 if px >= width - 1 - px else width - 1
+    ty = 0 if py >= height - 1 - py else height - 1
+    x, y = px, py
+    while (x, y) != (tx, ty):
+        if y == ty or (x != tx and rng.random() < 0.5):
+            x += 1 if tx > x else -1
+        else:
+            y += 1 if ty > y else -1
+        keep[x * height + y] = 1
+
+    return keep
+
+def generate(map_size, n_enemies=None, n_blocks=None,
+        enemy_density=0.09, block_density=0.3, enemy_mix=ENEMY_MIX,
+        player=(0, 0), escape=1, safe_distance=4, cover=True,
+        hard_grid=True, hard_density=0.0, seed=None):
+    """Generate the layout of a stage.
+
+    Every cell without a hard block can be reached from the player
+    (soft blocks can be destroyed), since cells cut off by
+    hard blocks are filled with hard blocks.
+
+    @param map_size: (width, height) in cells
+    @param n_enemies: the number of enemies
+        (The default value None means enemy_density of free cells.)
+    @param n_blocks: the number of soft blocks
+        (The default value None means block_density of free cells
+        after enemies are put.)
+    @param enemy_mix: a list of (character of enemy, weight)
+    @param player: the cell of the player
+    @param escape: cells within this number of steps from the player
+        are kept empty, for the player to escape from the first bomb
+    @param safe_distance: enemies are put further than this
+        number of steps from the player
+    @param cover: put soft blocks on all free cells at escape + 1 steps
+        from the player, besides n_blocks (as the classic stages, 
+        where the player starts behind two blocks)
+    @param hard_grid: put hard blocks in all cells
+        with odd x and odd y (as the classic stages)
+    @param hard_density: the ratio of cells with additional
+        hard blocks randomly put, except the cells of keep_open()
+        (With hard_grid, it is the ratio of walls closed 
+        between blocks of the grid, see put_walls().)
+    @param seed: the seed of random numbers
+        (The same seed and parameters give the same layout.)
+    @return: stagegen.Layout
+
+    """
+    rng = Random(seed)
+    random = rng.random
+    width, height = map_size
+    n = width * height
+    cells = array('c', EMPTY) * n
+
+    # Hard blocks
+    if hard_grid:
+        for x in xrange(1, width, 2):
+            for y in xrange(1, height, 2):
+                cells[x * height + y] = HARD_BLOCK
+
+    if hard_grid and hard_density > 0:
+        put_walls(cells, map_size, hard_density, rng)
+    elif hard_density > 0:
+        keep = keep_open(map_size, player, escape, rng)
+        for i in xrange(0, int(hard_density * n)):
+            index = int(random() * n)
+            if not keep[index]:
+                cells[index] = HARD_BLOCK
+
+    player_index = player[0] * height + player[1]
+    cells[player_index] = PLAYER
+
+    # Seal cells cut off from the player
+    dist = distances(cells, map_size, player)
+    for index in xrange(0, n):
+        if dist[index] < 0:
+            cells[index] = HARD_BLOCK
+
+    # Free cells for enemies and soft blocks
+    enemy_cells = FreeCells(map_size, random)
+    block_cells = FreeCells(map_size, random)
+    for index in xrange(0, n):
+        d = dist[index]
+        if d < 0 or d <= escape:
+            enemy_cells.take_index(index)
+            block_cells.take_index(index)
+        elif cover and d == escape + 1:
+            cells[index] = SOFT_BLOCK
+            enemy_cells.take_index(index)
+            block_cells.take_index(index)
+        elif d <= safe_distance:
+            enemy_cells.take_index(index)
+
+    # Enemies
+    kinds = []
+    for c, weight in enemy_mix:
+        kinds.extend([c] * weight)
+
+    if n_enemies is None:
+        n_enemies = int(enemy_density * len(enemy_cells))
+
+    for i in xrange(0, n_enemies):
+        cell = enemy_cells.sample()
+        if cell is None:
+            break
+
+        x, y = cell
+        cells[x * height + y] = kinds[int(random() * len(kinds))]
+        # Keep other enemies and soft blocks away from the enemy
+        for nx, ny in ((x, y), (x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            enemy_cells.take(nx, ny)
+            block_cells.take(nx, ny)
+
+    # Soft blocks
+    if n_blocks is None:
+        n_blocks = int(block_density * len(block_cells))
+
+    for i in xrange(0, n_blocks):
+        cell = block_cells.sample()
+        if cell is None:
+            break
+
+        cells[cell[0] * height + cell[1]] = SOFT_BLOCK
+
+    return Layout(map_size, cells, player)
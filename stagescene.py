@@ -7,17 +7,17 @@ the core of this game.
 """
 
 from random import random
+from array import array
 
-import gtk
-import gtk.gdk as gdk
-import gobject
 import cairo
 
 from pnode import Node
+from tracing import traced
 from objects import *
 from effects import *
 from uicomponents import *
 from stagecontroller import *
+import stagegen
 
 # The z-index table
 layers = {
@@ -52,13 +52,18 @@ class StageScene(Node):
                 map_size=self.map_size
                 )
         self.add_node(self.map)
+        # The cell of the player seen by tracking floors
+        self.player_cell = None
+        # The time until which each cell is on fire (see is_fire())
+        self.fire_expiry = array('d', [0.0]) * \
+                (self.map_size[0] * self.map_size[1])
 
     def create_floor(self):
         """Create a floor object in all cells."""
         def _on_enter(obj):
             return lambda: obj.play_blink(duration=1, loop=True)
         def _on_leave(obj):
-            return lambda: obj.play_fadeout(duration=1)
+            return lambda: obj.stop_blink(duration=1)
 
         cell_size = self.map.get_cell_size()
         for x in xrange(0, self.map_size[0]):
@@ -71,11 +76,14 @@ class StageScene(Node):
                             'z-index': layers['floor'] }
                         )
                 # Make it blinking when the player stays on it
-                make_trackingfloor(self, obj, x, y, 
+                make_trackingfloor(obj, 
                         on_enter=_on_enter(obj),
                         on_leave=_on_leave(obj)
                         )
                 self.map.add_node(obj, x, y)
+                # Floors never overlap each other, 
+                # so all of them could be drawn at once
+                self.map.bake(obj, layers['floor'])
 
     def create_player_at(self, x, y):
         """Create the player at the specified cell.
@@ -250,40 +258,6 @@ class StageScene(Node):
         self.map.add_node(obj, x, y, 0, -cell_size)
         return obj
 
-    def create_enemies(self, count):
-        """Create [count] enemies with random type."""
-        self.enemies = []
-
-        while count > 0:
-            # Randomly select a cell
-            x = int(random() * self.map_size[0])
-            y = int(random() * self.map_size[1])
-
-            # If it has been filled with something, choose another cell
-            if self.is_filled(x, y):
-                continue
-
-            # Randomly select a type of enemy to generate
-            r = int(random() * 10)
-            if 4 < r and r < 8:
-                enemy = self.create_enemy_bombeater_at(x, y)
-            elif r == 8:
-                enemy = self.create_enemy_flying_at(x, y)
-            elif r == 9:
-                enemy = self.create_enemy_bomber_at(x, y)
-            else:
-                enemy = self.create_enemy_normal_at(x, y)
-
-            # Create dummy objects to prevent enemies 
-            # from concentrating at one place
-            self.create_dummy_obj_at(x - 1, y)
-            self.create_dummy_obj_at(x + 1, y)
-            self.create_dummy_obj_at(x, y - 1)
-            self.create_dummy_obj_at(x, y + 1)
-
-            self.enemies.append(enemy)
-            count -= 1
-
     def create_hard_block_at(self, x, y):
         """Create a hard block at specified cell.
         
@@ -302,14 +276,10 @@ class StageScene(Node):
         fireblocking(block(obj))
 
         self.map.add_node(obj, x, y, 0, -cell_size)
+        # Hard blocks in the same row are drawn at once
+        self.map.bake(obj)
         return obj
 
-    def create_hard_blocks(self):
-        """Create hard blocks in a grid form."""
-        for x in xrange(1, self.map_size[0], 2):
-            for y in xrange(1, self.map_size[1], 2):
-                self.create_hard_block_at(x, y)
-
     def create_soft_block_at(self, x, y):
         """Create a soft block at specified cell.
         
@@ -333,49 +303,6 @@ class StageScene(Node):
         self.map.add_node(obj, x, y, 0, -cell_size)
         return obj
 
-    def create_soft_blocks(self, count):
-        """Randomly create [count] soft blocks.
-        
-        Cells that has been filled with more than one object 
-        (exactly, more than the Floor object) will not be chosen.
-
-        """
-        while count > 0:
-            x = int(random() * self.map_size[0])
-            y = int(random() * self.map_size[1])
-            if self.is_filled(x, y):
-                continue
-
-            self.create_soft_block_at(x, y)
-            count -= 1
-
-    def create_dummy_obj_at(self, x, y):
-        """Create a dummy object at specified cell.
-
-        This dummy object is used to avoid soft blocks.
-
-        """
-        if not (0 <= x and x < self.map_size[0] and
-                0 <= y and y < self.map_size[1]):
-            return
-
-        # Because every node needs to create it's surface,
-        # create a smallest surface with only 1x1 px.
-        # XXX: bad approach
-        obj = Node(self.map, {'width': 1, 'height': 1})
-        self.map.add_node(obj, x, y)
-        try:
-            self.dummies.append(obj)
-        except AttributeError:
-            self.dummies = [obj]
-
-    def clear_dummy_obj(self):
-        """Clear dummy objects after the creation of stage."""
-        for d in self.dummies:
-            self.map.remove_node(d)
-
-        self.dummies = []
-
     def __init__(self, parent, style, 
             audio, map_size, margin, key_up, key_down, 
             on_game_reset, on_game_win):
@@ -397,6 +324,8 @@ class StageScene(Node):
         self.on_game_win = on_game_win
         self.win = False
         self.lose = False
+        # The time since the stage started
+        self.elapsed = 0.0
         
         # The message box to display win / lose
         self.msg = MessageBox(
@@ -414,19 +343,57 @@ class StageScene(Node):
         self.texture = {}
         self.texture['bgimg'] = cairo.ImageSurface.create_from_png('stage_bg.png')
 
-    def generate(self, n_enemies, n_blocks):
-        """Randomly generate a new stage."""
+    def generate(self, n_enemies, n_blocks, seed=None):
+        """Randomly generate a new stage (see stagegen.generate()).
+        
+        @param seed: the seed of random numbers 
+            (The default value None means a seed taken 
+            from module random.)
+
+        """
+        if seed is None:
+            seed = random()
+
+        layout = stagegen.generate(self.map_size, n_enemies, n_blocks, 
+                seed=seed)
+        self.build(layout)
+
+    def build(self, layout):
+        """Create the stage from a stagegen.Layout.
+        
+        All objects are created in one pass over the layout.
+
+        """
+        self.enemies = []
         self.create_map()
         self.create_floor()
-        self.player = self.create_player_at(0, 0)
-        self.create_dummy_obj_at(0, 1)
-        self.create_dummy_obj_at(1, 0)
-        self.create_soft_block_at(0, 2)
-        self.create_soft_block_at(2, 0)
-        self.create_hard_blocks()        
-        self.create_enemies(n_enemies)
-        self.create_soft_blocks(n_blocks)        
-        self.clear_dummy_obj()
+        for x, y, c in layout.objects():
+            self.create_object_at(c, x, y)
+
+    def create_object_at(self, c, x, y):
+        """Create an object at the specified cell.
+        
+        @param c: the character of object (see parse())
+
+        """
+        if c == stagegen.HARD_BLOCK:
+            self.create_hard_block_at(x, y)
+        elif c == stagegen.PLAYER:
+            self.player = self.create_player_at(x, y)
+        elif c == stagegen.SOFT_BLOCK:
+            self.create_soft_block_at(x, y)
+        elif c == stagegen.ENEMY_NORMAL:
+            e = self.create_enemy_normal_at(x, y)
+            self.enemies.append(e)
+        elif c == stagegen.ENEMY_BOMBEATER:
+            e = self.create_enemy_bombeater_at(x, y)
+            self.enemies.append(e)
+        elif c == stagegen.ENEMY_FLYING:
+            e = self.create_enemy_flying_at(x, y)
+            self.enemies.append(e)
+        elif c == stagegen.ENEMY_BOMBER:
+            e = self.create_enemy_bomber_at(x, y)
+            self.enemies.append(e)
 
     def parse(self, stage_str, n_blocks):
         """Parse a string to generate the stage.
@@ -434,7 +401,7 @@ class StageScene(Node):
         The format of stage_str:
             - 'x': hard block
             - 'o': soft block
-            - '.': dummy object
+            - '.': reserved cell
             - '@': player
             - 'A': normal enemy
             - 'B': bomb eater
@@ -442,43 +409,13 @@ class StageScene(Node):
             - 'D': bomber enemy
 
         @param n_blocks: the bumber of soft blocks to be randomly generated
-            after the stage has being loaded
+            after the stage has being loaded 
+            (not on objects and reserved cells)
 
         """
-        self.enemies = []
-        self.create_map()
-        self.create_floor()
-
-        stage_str = stage_str.strip()
-        rows = stage_str.split('\n')
-        for y in xrange(0, self.map_size[1]):
-            for x in xrange(0, self.map_size[0]):
-                c = rows[y][x]
-                if c == 'x':
-                    self.create_hard_block_at(x, y)
-                elif c == '@':
-                    self.player = self.create_player_at(x, y)
-                elif c == '.':
-                    self.create_dummy_obj_at(x, y)
-                elif c == 'o':
-                    self.create_soft_block_at(x, y)
-                elif c == 'A':
-                    e = self.create_enemy_normal_at(x, y)
-                    self.enemies.append(e)
-                elif c == 'B':
-                    e = self.create_enemy_bombeater_at(x, y)
-                    self.enemies.append(e)
-                elif c == 'C':
-                    e = self.create_enemy_flying_at(x, y)
-                    self.enemies.append(e)
-                elif c == 'D':
-                    e = self.create_enemy_bomber_at(x, y)
-                    self.enemies.append(e)
-                elif c == ' ':
-                    pass
-
-        self.create_soft_blocks(n_blocks)        
-        self.clear_dummy_obj()
+        layout = stagegen.parse(stage_str, self.map_size)
+        stagegen.put_soft_blocks(layout, n_blocks)
+        self.build(layout)
 
     def on_update(self, cr):
         """Simply display the background image.
@@ -498,7 +435,6 @@ class StageScene(Node):
         x = (self.width - new_width)/2
         y = (self.height - new_height)/2
 
-        cr = cairo.Context(self.surface)
         cr.scale(scale, scale)
         cr.set_source_rgb(0, 0, 0)
         cr.paint()
@@ -519,6 +455,7 @@ class StageScene(Node):
         self.msg.set_text(u'YOU LOSE <Press Space>')
         self.msg.show(True)
 
+    @traced('StageScene.on_tick')
     def on_tick(self, interval):
         """Check the player input, 
         and check the status of the player and enemies.
@@ -546,40 +483,70 @@ class StageScene(Node):
         # XXX: should be merged into character's check() method
         #
 
+        map = self.map
+        self.track_player()
+
         # Check player's status
         if not self.lose and not self.win:
-            cell = self.map.get_cell(self.player)
-            for n in self.map.get_cell_nodes(*cell):
-                if is_enemy(n):
-                    # Ran into an enemy
-                    self.game_lose()
-                elif is_fire(n):
-                    # Ran into the fire of bomb
-                    self.game_lose()
-                elif is_item(n):
-                    # Eat the item
-                    n.eat(self.player)
+            cell = map.get_cell(self.player)
+            flags = map.get_cell_flags(*cell)
+            if flags & ENEMY or self.is_fire(*cell):
+                # Ran into an enemy or the fire of bomb
+                self.game_lose()
+            if flags & ITEM:
+                for n in list(map.get_cell_nodes(*cell)):
+                    if is_item(n):
+                        # Eat the item
+                        n.eat(self.player)
 
         # Check enemies' status
-        tmp = self.enemies
-        for e in tmp:
-            cell = self.map.get_cell(e)
-            for n in self.map.get_cell_nodes(*cell):
-                if is_fire(n) and not is_dead(n):
-                    # Ran into the fire of bomb
-                    e.go_die()
-                    self.enemies.remove(e)
-                    break
-                elif is_bombeater(e) and is_bomb(n):
-                    # The bombeater eat the bomb
-                    n.bomber.cur_bomb_count -= 1
-                    self.map.remove_node(n)
-                    continue
+        for e in list(self.enemies):
+            cell = map.get_cell(e)
+            flags = map.get_cell_flags(*cell)
+            if flags & BOMB and is_bombeater(e):
+                for n in list(map.get_cell_nodes(*cell)):
+                    if is_bomb(n):
+                        # The bombeater eat the bomb
+                        n.bomber.cur_bomb_count -= 1
+                        map.remove_node(n)
+
+            if self.is_fire(*cell):
+                # Ran into the fire of bomb
+                e.go_die()
+                self.enemies.remove(e)
 
         # Check the winning condition
         if len(self.enemies) == 0 and not self.win:
             self.game_win()
 
+        # Fire put by actions after this (see Node.do_tick_recursive())
+        # is counted from the end of this tick
+        self.elapsed += interval
+
+    def track_player(self):
+        """Call the callbacks of tracking floors 
+        if the player has moved to another cell."""
+        cell = self.map.get_cell(self.player)
+        if cell == self.player_cell:
+            return
+
+        old_cell = self.player_cell
+        self.player_cell = cell
+        if (old_cell is not None 
+                and self.map.get_cell_flags(*old_cell) & TRACKING):
+            for n in self.map.get_cell_nodes(*old_cell):
+                if is_trackingfloor(n):
+                    n.on_player_leave()
+
+        if self.map.get_cell_flags(*cell) & TRACKING:
+            for n in self.map.get_cell_nodes(*cell):
+                if is_trackingfloor(n):
+                    n.on_player_enter()
+
+    def is_fire(self, x, y):
+        """Return true if the cell is on fire."""
+        return self.fire_expiry[x * self.map_size[1] + y] > self.elapsed
+
     def is_filled(self, x, y):
         """Return true 
         if the cell has been filled with more than one object.
@@ -605,21 +572,25 @@ class StageScene(Node):
                 and 0 <= y and y < self.map_size[1]):
             return True
 
-        # Check individual nodes in the cell
-        for target in self.map.get_cell_nodes(x, y):
-            if is_bombeater(node) and is_bomb(target):
-                # Bombeater can move over a bomb
-                continue
-            elif is_flying(node) and not is_bomb(target):
-                # Flying enemy can not fly over a bomb
-                # (It is designed in order to kill them easier)
-                continue
-            elif is_block(target):
-                return True
-            elif is_player(node) and is_player(target):
-                return True
-            elif is_enemy(node) and is_enemy(target):
+        # Check the flags of nodes in the cell
+        flags = self.map.get_cell_flags(x, y)
+        if is_flying(node):
+            # Flying enemy can not fly over a bomb
+            # (It is designed in order to kill them easier)
+            return bool(flags & BOMB) and not is_bombeater(node)
+
+        if flags & BOMB and is_bombeater(node):
+            # Bombeater can move over a bomb (bombs are blocks as well)
+            if (self.map.count_cell_flag(x, y, BLOCK) > 
+                    self.map.count_cell_flag(x, y, BOMB)):
                 return True
+        elif flags & BLOCK:
+            return True
+
+        if is_player(node) and flags & PLAYER:
+            return True
+        elif is_enemy(node) and flags & ENEMY:
+            return True
 
         return False
 
@@ -682,11 +653,9 @@ class StageScene(Node):
         @type bomber: pnode.Node with make_bomber()
 
         """
-        nodes = self.map.get_cell_nodes(x, y)
-        for n in nodes:
-            if is_bomb(n):
-                # There is already a bomb in the cell
-                return False
+        if self.map.get_cell_flags(x, y) & BOMB:
+            # There is already a bomb in the cell
+            return False
 
         # Create the bomb
         cell_size = self.map.get_cell_size()
@@ -756,11 +725,12 @@ class StageScene(Node):
         elif 6 < r and r <= 9:
             self.put_bombitem(x, y)
 
+    @traced('StageScene.explode')
     def explode(self, node, x, y, power):
         """This method do all the jobs when a bomb explode.
             1. Calculate the path of fire.
             2. Destroy things on the path.
-            3. Put 'fire objects' to kill characters who entered the path later.
+            3. Set the path on fire to kill characters who entered the path later.
             4. Display the effect.
 
         @param node: the bomb that has been exploded (currently not using)
@@ -778,8 +748,10 @@ class StageScene(Node):
                 self.set_rotate(a * sin(phase * 8 * 2 * pi))
 
             for n in nodes:
-                # Make it shaking
-                n.add_action('shake', _shake, duration=2, update=True)
+                # Make it shaking, and put it straight at the end
+                # (or the terrain layer could never bake it again)
+                n.add_action('shake', _shake, duration=2, 
+                        cleanup=n.set_rotate)
                 if is_player(n):
                     # The player is dead, you lose
                     self.game_lose()
@@ -804,18 +776,11 @@ class StageScene(Node):
             return (False, 0)
 
         def _put_fire(x, y):
-            # Put an invisible fire object to target cell.
-            # This fire object may destroy characters coming in.
-            # XXX: invisible object
-            _fire = Node(self.map, {'width': 1, 'height': 1})
-            fire(_fire)
-            self.map.add_node(_fire, x, y)
-            def _die_latter(node, interval, phase):
-                pass
-
-            # Let the fire disppear after FIRE_LASTING seconds
-            _fire.add_action('die', _die_latter, delay=FIRE_LASTING, 
-                    cleanup=lambda: self.map.remove_node(_fire))
+            # Set the target cell on fire for FIRE_LASTING seconds.
+            # The fire may destroy characters coming in (see on_tick()).
+            index = x * self.map_size[1] + y
+            self.fire_expiry[index] = max(self.fire_expiry[index], 
+                    self.elapsed + FIRE_LASTING)
 
         #
         # Search in four directions
@@ -882,5 +847,5 @@ class StageScene(Node):
         def _shake(self, interval, phase):
             a = (pi / 8) * (1.0 - phase)
             self.set_rotate(a * sin(phase * 8 * 2 * pi))
-        explosion.add_action('shake', _shake, duration=2, update=True)
+        explosion.add_action('shake', _shake, duration=2)
 
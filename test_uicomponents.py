@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the terrain layer in uicomponents.
+
+Run with: python -m unittest test_uicomponents
+
+"""
+
+import unittest
+
+from pnode import Node
+from uicomponents import MapContainer
+
+class Window(object):
+    """The parent of the top node (in place of the game)."""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+def union(nodes):
+    left = min([n.x for n in nodes])
+    top = min([n.y for n in nodes])
+    right = max([n.x + n.width for n in nodes])
+    bottom = max([n.y + n.height for n in nodes])
+    return (left, top, right - left, bottom - top)
+
+class TerrainStripTest(unittest.TestCase):
+    def setUp(self):
+        self.window = Window(400, 400)
+        self.top = Node(self.window, {'width': '100%', 'height': '100%'})
+        self.map = MapContainer(self.top,
+                {'width': '100%', 'height': '100%'}, (10, 10))
+        self.top.add_node(self.map)
+        self.nodes = []
+        for x in xrange(0, 10):
+            for y in (2, 7):
+                node = Node(self.map, {'width': 40, 'height': 40})
+                self.map.add_node(node, x, y)
+                self.map.terrain.bake(node, 0)
+                self.nodes.append(node)
+
+        self.strip = self.map.terrain.strips[0]
+
+    def resize(self, width, height):
+        self.window.width = width
+        self.window.height = height
+        self.top.do_resize_recursive()
+
+    def test_baked(self):
+        self.assertEqual(
+                (self.strip.x, self.strip.y,
+                    self.strip.width, self.strip.height),
+                union(self.nodes))
+
+    def test_resize_down(self):
+        self.resize(200, 150)
+        self.assertEqual(
+                (self.strip.x, self.strip.y,
+                    self.strip.width, self.strip.height),
+                union(self.nodes))
+        # Baked again without drawing themselves
+        self.assertFalse(self.map.terrain.unbaked)
+
+    def test_resize_up_and_down(self):
+        self.resize(1000, 900)
+        self.resize(300, 260)
+        self.assertEqual(
+                (self.strip.x, self.strip.y,
+                    self.strip.width, self.strip.height),
+                union(self.nodes))
+
+    def test_discard(self):
+        for node in self.nodes[:10]:
+            self.map.remove_node(node)
+
+        self.assertEqual(
+                (self.strip.x, self.strip.y,
+                    self.strip.width, self.strip.height),
+                union(self.nodes[10:]))
+
+if __name__ == '__main__':
+    unittest.main()
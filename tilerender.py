@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""The tiled renderer of the pnode framework.
+
+The frame is divided into square tiles, and the damaged tiles are
+painted in parallel by a pool of processes.
+No pixel data is passed between processes:
+
+    - The frame buffer is a shared memory map,
+      which all processes wrap with cairo.ImageSurface.create_for_data().
+
+    - Surfaces of nodes are copied (by the main process,
+      only when changed) into the atlas, another shared image,
+      so the display list sent to the workers only has the positions
+      of the rasters in the atlas.
+
+The shared memory is passed to the processes by fork(),
+so this renderer works only on Unix.
+
+Only the compositing of tiles runs in the processes.
+Surfaces of nodes are still rasterized by on_update() and animations
+in the main process, since they read the live node tree,
+which the processes cannot reach. The main process also copies
+the changed surfaces into the atlas in each frame (see upload()).
+So the pool pays for itself only when compositing large windows
+outweighs that and the cost of passing tasks (the display list)
+to the processes. Measure it against painting in one process with:
+
+    python benchmark.py -s 4
+
+Use it as the render worker of a game:
+
+    game.render_worker = TiledRenderer(game.width, game.height)
+
+"""
+
+import mmap
+from multiprocessing import Pool, cpu_count
+from time import time
+
+import cairo
+
+from pnode import paint_display_item, rect_intersects
+
+def create_shared_surface(width, height):
+    """Return (memory map, surface) of an image in shared memory.
+
+    The memory is shared with processes forked later.
+
+    """
+    stride = cairo.ImageSurface.format_stride_for_width(
+            cairo.FORMAT_ARGB32, width)
+    buf = mmap.mmap(-1, max(1, stride * height))
+    return buf, wrap_surface(buf, width, height)
+
+def wrap_surface(buf, width, height):
+    """Return an image surface using the memory (which could be larger)."""
+    stride = cairo.ImageSurface.format_stride_for_width(
+            cairo.FORMAT_ARGB32, width)
+    return cairo.ImageSurface.create_for_data(
+            buf, cairo.FORMAT_ARGB32, width, height, stride)
+
+class Atlas(object):
+    """The shared image holding copies of node surfaces.
+
+    Copies are packed in rows (shelves). When the atlas is full,
+    it is emptied and the copies needed are made again.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buf, self.surface = create_shared_surface(size, size)
+        self.reset()
+
+    def reset(self):
+        """Forget all copies."""
+        # (id of surface, slot) -> (surface, serial, x, y, width, height)
+        self.copies = {}
+        self.x = 0          # the position of the next copy
+        self.y = 0
+        self.row_height = 0
+
+    def _alloc(self, width, height):
+        if self.x + width > self.size:
+            # Start a new row
+            self.x = 0
+            self.y += self.row_height
+            self.row_height = 0
+
+        if width > self.size or self.y + height > self.size:
+            return None
+
+        pos = (self.x, self.y)
+        self.x += width
+        self.row_height = max(self.row_height, height)
+        return pos
+
+    def lookup(self, cr, surface, slot, width, height, serial):
+        """Return the position of the copy of the surface in the atlas.
+
+        A copy is made if there isn't one, or the surface has been
+        painted since (told by the serial, see pnode.Node.mark_painted()).
+
+        @return: (x, y), or None if the atlas is full
+
+        """
+        key = (id(surface), slot)
+        copy = self.copies.get(key)
+        if copy and copy[1] == serial:
+            return copy[2], copy[3]
+
+        width = int(width + 0.5)
+        height = int(height + 0.5)
+        if copy and copy[4] >= width and copy[5] >= height:
+            # Overwrite the old copy
+            pos = copy[2:4]
+            width, height = copy[4:]
+        else:
+            pos = self._alloc(width, height)
+            if pos is None:
+                return None
+
+        src_x, src_y = slot if slot else (0, 0)
+        cr.save()
+        cr.rectangle(pos[0], pos[1], width, height)
+        cr.clip()
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        cr.set_source_surface(surface, pos[0] - src_x, pos[1] - src_y)
+        cr.paint()
+        cr.restore()
+        # Keep the surface, so that its id is not taken by another one
+        self.copies[key] = (surface, serial) + pos + (width, height)
+        return pos
+
+# The shared images in worker processes
+_worker_frame_buf = None
+_worker_frame = None
+_worker_atlas = None
+
+def _init_worker(frame_buf, atlas_buf, atlas_size):
+    global _worker_frame_buf, _worker_atlas
+    _worker_frame_buf = frame_buf
+    _worker_atlas = wrap_surface(atlas_buf, atlas_size, atlas_size)
+
+def _paint_tiles(task):
+    """Paint the tiles into the shared frame (run in worker processes).
+
+    @param task: ((width, height) of the frame, tiles, items), 
+        where items are display items
+        with the position in the atlas instead of the surface
+
+    """
+    global _worker_frame
+    size, tiles, items = task
+    if (_worker_frame is None or size != 
+            (_worker_frame.get_width(), _worker_frame.get_height())):
+        # Resized, the buffer is large enough
+        _worker_frame = wrap_surface(_worker_frame_buf, *size)
+
+    _worker_atlas.mark_dirty()
+    cr = cairo.Context(_worker_frame)
+    for tile in tiles:
+        cr.save()
+        cr.rectangle(*tile)
+        cr.clip()
+        cr.set_operator(cairo.OPERATOR_CLEAR)
+        cr.paint()
+        cr.set_operator(cairo.OPERATOR_OVER)
+        for pos, width, height, x, y, matrix, alpha, bbox in items:
+            if not rect_intersects(tile, bbox):
+                continue
+            if matrix is not None:
+                matrix = cairo.Matrix(*matrix)
+            paint_display_item(cr, (_worker_atlas, pos, width, height,
+                x, y, matrix, alpha, 0, bbox))
+        cr.restore()
+
+    _worker_frame.flush()
+
+class TiledRenderer(object):
+    """Paint frames by a pool of processes, tile by tile.
+
+    It has the same interface as pnode.RenderWorker,
+    but each frame is done before submit() returns.
+
+    """
+    # Surfaces of nodes are read by upload() in the main process,
+    # so they are painted there as well
+    rasterizes = False
+
+    def __init__(self, width, height, processes=None,
+            tile_size=128, atlas_size=2048):
+        """Create the shared images and start the processes.
+
+        @param processes: the number of processes
+            (The default value None means the number of cpus.)
+        @param tile_size: the width and height of a tile
+        @param atlas_size: the min width and height of the atlas
+            (It is at least twice as large as the window.)
+
+        """
+        self.processes = processes or cpu_count()
+        self.tile_size = tile_size
+        self.atlas_size = atlas_size
+        self.atlas = None
+        self.pool = None
+        self.frame_buf = None
+        self.done = []
+        self.done_all = False
+        self.cost = 0.0             # the time spent on the last frame
+        self.upload_cost = 0.0      # the part spent on upload()
+        self.resize(width, height)
+
+    def resize(self, width, height):
+        """Resize the frame buffer (it will be fully repainted).
+
+        The shared memory is kept when it is large enough.
+        It is allocated again only when the frame or the atlas 
+        has to grow, and then the processes are restarted to share it.
+
+        """
+        stride = cairo.ImageSurface.format_stride_for_width(
+                cairo.FORMAT_ARGB32, width)
+        atlas_size = max(self.atlas_size, 2 * width, 2 * height)
+        grown = False
+        if self.frame_buf is None or len(self.frame_buf) < stride * height:
+            self.frame_buf = mmap.mmap(-1, max(1, stride * height))
+            grown = True
+        if self.atlas is None or self.atlas.size < atlas_size:
+            self.atlas = Atlas(atlas_size)
+            grown = True
+        if grown:
+            self.start()
+
+        self.width = width
+        self.height = height
+        self.frame = wrap_surface(self.frame_buf, width, height)
+
+    def start(self):
+        """(Re)start the processes to share the frame buffer and the atlas.
+        """
+        self.close()
+        self.pool = Pool(self.processes, _init_worker,
+                (self.frame_buf, self.atlas.buf, self.atlas.size))
+
+    def close(self):
+        """Stop the processes."""
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def get_tiles(self, clip):
+        """Return the tiles intersecting the rectangles (None for all)."""
+        size = self.tile_size
+        tiles = []
+        for y in xrange(0, self.height, size):
+            for x in xrange(0, self.width, size):
+                tile = (x, y, min(size, self.width - x),
+                        min(size, self.height - y))
+                if clip is None:
+                    tiles.append(tile)
+                    continue
+
+                for rect in clip:
+                    if rect_intersects(rect, tile):
+                        tiles.append(tile)
+                        break
+
+        return tiles
+
+    def upload(self, display_list, retry=True):
+        """Copy the surfaces into the atlas.
+
+        When the atlas is full, it is emptied, 
+        and it is enlarged if the frame still does not fit.
+
+        @return: the display list for the workers
+
+        """
+        atlas = self.atlas
+        cr = cairo.Context(atlas.surface)
+        items = []
+        for (surface, slot, width, height, x, y, matrix, alpha,
+                serial, bbox) in display_list:
+            pos = atlas.lookup(cr, surface, slot, width, height, serial)
+            if pos is None:
+                if retry:
+                    # Full, start over with this frame
+                    atlas.reset()
+                else:
+                    # Too small for this frame
+                    self.atlas = Atlas(2 * atlas.size)
+                    self.start()
+                return self.upload(display_list, False)
+
+            if matrix is not None:
+                matrix = tuple(matrix)
+            items.append((pos, width, height, x, y, matrix, alpha, bbox))
+
+        atlas.surface.flush()
+        return items
+
+    def submit(self, display_list, clip, rasters=()):
+        """Paint a frame.
+
+        @param clip: a list of rectangles changed in this frame
+            (None for all)
+        @param rasters: always empty, since rasterizes is false
+
+        """
+        start = time()
+        self.upload_cost = 0.0
+        tiles = self.get_tiles(clip)
+        if tiles:
+            items = self.upload(display_list)
+            self.upload_cost = time() - start
+            # Interleave the tiles, so that busy areas are shared
+            n = min(self.processes, len(tiles))
+            size = (self.width, self.height)
+            tasks = []
+            for i in range(0, n):
+                part = tiles[i::n]
+                tasks.append((size, part, [item for item in items
+                    if any(rect_intersects(tile, item[-1])
+                        for tile in part)]))
+
+            self.pool.map(_paint_tiles, tasks)
+            self.frame.mark_dirty()
+
+        if clip is None:
+            self.done_all = True
+        else:
+            self.done.extend(clip)
+        self.cost = time() - start
+
+    def wait(self):
+        pass
+
+    def take_done(self):
+        """Return the damage of frames done since the last call
+        (None for all, empty if no frame is done)."""
+        rects = None if self.done_all else self.done
+        self.done = []
+        self.done_all = False
+        return rects
+
+    def blit(self, cr):
+        """Copy the last frame to the context."""
+        cr.set_source_surface(self.frame, 0, 0)
+        cr.paint()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""The tracer of time spans in the Chrome trace event format.
+
+It does not depend on the rest of the pnode framework, 
+so any module could be traced:
+
+    from tracing import traced
+
+    @traced('AudioManager.play')
+    def play(self, name):
+        ...
+
+Tracing is turned on by tracer.start(filename).
+
+"""
+
+import os
+import json
+from time import time
+from functools import wraps
+from threading import Thread, current_thread
+from Queue import Queue
+
+class Tracer(object):
+    """Record spans of time in the Chrome trace event format.
+
+    The trace could be opened in chrome://tracing.
+    Events are buffered, and written to the file by a thread.
+
+    """
+    def __init__(self):
+        self.enabled = False
+        # Updates of a node shorter than this (in seconds) are not traced
+        self.threshold = 0.0005
+        self.buffer_size = 1000
+        self.events = []
+        self.queue = None
+        self.thread = None
+
+    def start(self, filename):
+        """Start tracing into the file."""
+        self.stop()
+        self.pid = os.getpid()
+        self.origin = time()
+        self.events = []
+        self.queue = Queue()
+        self.thread = Thread(target=self.write, args=(filename, self.queue))
+        self.thread.daemon = True
+        self.thread.start()
+        self.enabled = True
+
+    def stop(self):
+        """Write the rest of events and close the file."""
+        if not self.enabled:
+            return
+
+        self.enabled = False
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def add(self, name, start, category='pnode'):
+        """Record a span from the time start until now."""
+        now = time()
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': (now - start) * 1e6,
+            'pid': self.pid,
+            'tid': current_thread().ident,
+            })
+        if len(self.events) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Hand over the buffered events to the writer."""
+        if self.events:
+            self.queue.put(self.events)
+            self.events = []
+
+    def write(self, filename, queue):
+        """The main loop of the writer thread."""
+        with open(filename, 'w') as f:
+            f.write('[\n')
+            first = True
+            while True:
+                events = queue.get()
+                if events is None:
+                    break
+
+                for event in events:
+                    if not first:
+                        f.write(',\n')
+                    f.write(json.dumps(event))
+                    first = False
+
+            f.write('\n]\n')
+
+# The tracer used by all modules
+tracer = Tracer()
+
+def traced(name):
+    """A decorator to trace calls of the function (see Tracer).
+    
+    @param name: the name of spans
+
+    """
+    def _decorate(f):
+        @wraps(f)
+        def _traced(*args, **kw):
+            if not tracer.enabled:
+                return f(*args, **kw)
+
+            start = time()
+            try:
+                return f(*args, **kw)
+            finally:
+                tracer.add(name, start)
+
+        return _traced
+
+    return _decorate
@@ -8,17 +8,257 @@ and control logic altogether by themselves.
 
 from math import pi
 from math import sin
+from array import array
 
-import gtk
-import gtk.gdk as gdk
-import gobject
 import cairo
 import pango
 import pangocairo
 
 from pnode import Node
+from pnode import rect_intersects
+from pnode import sprite_cache
+from tracing import traced
 from objects import Bomb
 
+class TerrainStrip(Node):
+    """Nodes baked into one surface by TerrainLayer.
+    
+    All nodes in a strip share the same z-index.
+    The strip covers the bounding box of it's nodes.
+
+    """
+    def __init__(self, parent, z_index):
+        super(TerrainStrip, self).__init__(parent, 
+                {'width': 0, 'height': 0, 'z-index': z_index})
+        self.members = []
+        self.dirty = []     # areas to be redrawn
+        self.full = True    # should redraw all?
+
+    def update_geometry(self):
+        """Cover all nodes in this strip."""
+        if self.members:
+            left = min([n.x for n in self.members])
+            top = min([n.y for n in self.members])
+            right = max([n.x + n.width for n in self.members])
+            bottom = max([n.y + n.height for n in self.members])
+        else:
+            left, top, right, bottom = 0, 0, 0, 0
+
+        self._set_rect((left, top, right - left, bottom - top))
+
+    def include(self, rect):
+        """Grow to cover the rectangle (of a node being baked).
+        
+        It costs O(1), while update_geometry() looks into all nodes.
+        The strip never shrinks by it, so it is fitted again 
+        by update_geometry() after nodes are moved (see TerrainLayer).
+
+        """
+        if self.width > 0 or self.height > 0:
+            x = min(self.x, rect[0])
+            y = min(self.y, rect[1])
+            rect = (x, y, 
+                    max(self.x + self.width, rect[0] + rect[2]) - x, 
+                    max(self.y + self.height, rect[1] + rect[3]) - y)
+        self._set_rect(rect)
+
+    def _set_rect(self, rect):
+        if rect != (self.x, self.y, self.width, self.height):
+            self.set_style({
+                'left': rect[0],
+                'top': rect[1],
+                'width': rect[2],
+                'height': rect[3],
+                'z-index': self.z_index
+                })
+            self.full = True
+
+    def invalidate(self, rect):
+        """Redraw the area in the next update.
+        
+        @param rect: (x, y, width, height) relative to the map
+
+        """
+        rect = (rect[0] - self.x, rect[1] - self.y, rect[2], rect[3])
+        self.dirty.append(rect)
+        if self.painted_bbox:
+            self.lost_damage.append((
+                self.painted_bbox[0] + rect[0], 
+                self.painted_bbox[1] + rect[1],
+                rect[2], rect[3]))
+            self.notify_damage()
+
+    def _draw_members(self, cr, rect=None):
+        for node in self.members:
+            if node.layer is not self.parent:
+                # Drawn by itself
+                continue
+
+            node_rect = (node.x - self.x, node.y - self.y, 
+                    node.width, node.height)
+            if rect and not rect_intersects(rect, node_rect):
+                continue
+
+            cr.save()
+            cr.translate(node_rect[0], node_rect[1])
+            cr.rectangle(0, 0, node.width, node.height)
+            cr.clip()
+            node.on_update(cr)
+            cr.restore()
+
+    def do_update(self, interval):
+        """Redraw the whole strip or only the invalidated areas."""
+        if (self.full or self.surface is None 
+                or len(self.dirty) > len(self.members) / 2):
+            cr = self._get_context()
+            self._draw_members(cr)
+        elif self.dirty:
+            # The rest of the surface is kept
+            cr = self.create_context(self.dirty)
+            for rect in self.dirty:
+                cr.save()
+                cr.rectangle(*rect)
+                cr.clip()
+                self._draw_members(cr, rect)
+                cr.restore()
+
+        self.full = False
+        self.dirty = []
+        self.action_need_update = False
+
+class TerrainLayer(Node):
+    """The layer for static nodes in MapContainer (eg. floors and blocks).
+
+    Baked nodes are not drawn by themselves.
+    Instead, they are rasterized once into the surface of a TerrainStrip,
+    and composited with one paint for each strip.
+
+    When a baked node changes (see pnode.Node.damage()), 
+    it is unbaked to be drawn by itself, 
+    and only it's area in the strip is redrawn.
+    It is baked again after it becomes static.
+
+    """
+    def __init__(self, parent):
+        super(TerrainLayer, self).__init__(parent, {'width': 0, 'height': 0})
+        self.strips = {}        # z-index -> TerrainStrip
+        self.strip_of = {}      # node -> TerrainStrip
+        self.baked_rect = {}    # node -> the area it was baked
+        self.unbaked = set()
+
+    # Rotations smaller than it (in radians) are not drawn,
+    # since they are left by actions ending between ticks
+    ANG_TOLERANCE = 1e-3
+
+    @staticmethod
+    def is_static(node):
+        """Return true if the node could be drawn by on_update() only."""
+        state = node.surface_changed
+        return (not node.animation_list and not node.action_list
+                and not node.children
+                and node.alpha == 1.0 and node.dx == 0 and node.dy == 0
+                and not (state & Node.SURFACE_SCALE 
+                    and (node.sx, node.sy) != (1.0, 1.0))
+                and not (state & Node.SURFACE_ROTATE 
+                    and abs(node.ang) > TerrainLayer.ANG_TOLERANCE))
+
+    def bake(self, node, z_index=None):
+        """Bake the node into the strip of z_index.
+
+        Nodes could share a strip with another z-index 
+        if no other node will be drawn between them.
+
+        @param z_index: the z-index of the strip 
+            (The default value None means the z-index of node.)
+        
+        """
+        if z_index is None:
+            z_index = node.z_index
+
+        strip = self.strips.get(z_index)
+        if strip is None:
+            strip = TerrainStrip(self, z_index)
+            self.strips[z_index] = strip
+            self.add_node(strip)
+
+        strip.members.append(node)
+        self.strip_of[node] = strip
+        if self.is_static(node):
+            self._bake(node)
+        else:
+            self.unbaked.add(node)
+
+    def _bake(self, node):
+        strip = self.strip_of[node]
+        rect = (node.x, node.y, node.width, node.height)
+        strip.include(rect)
+        # The surface of node is useless until it is unbaked
+        node.free_surface()
+        if node.painted_bbox:
+            self.lost_damage.append(node.painted_bbox)
+            node.painted_bbox = None
+            self.notify_damage()
+
+        node.layer = self
+        self.baked_rect[node] = rect
+        strip.invalidate(rect)
+
+    def unbake(self, node):
+        """Let the node to be drawn by itself."""
+        node.layer = None
+        self.unbaked.add(node)
+        self.strip_of[node].invalidate(self.baked_rect.pop(node))
+
+    def discard(self, node):
+        """Remove the node from this layer (if it has been baked)."""
+        strip = self.strip_of.pop(node, None)
+        if strip is None:
+            return
+
+        if node.layer is self:
+            node.layer = None
+            strip.invalidate(self.baked_rect.pop(node))
+
+        self.unbaked.discard(node)
+        strip.members.remove(node)
+        strip.update_geometry()
+
+    def _bake_static(self):
+        """Bake nodes that have become static again, 
+        and fit their strips to the current nodes.
+        
+        """
+        strips = set()
+        for node in [n for n in self.unbaked if self.is_static(n)]:
+            self.unbaked.remove(node)
+            self._bake(node)
+            strips.add(self.strip_of[node])
+
+        for strip in strips:
+            # Nodes could have been moved while they were unbaked
+            strip.update_geometry()
+
+    def on_tick(self, interval):
+        """Bake nodes that have become static again."""
+        if self.unbaked:
+            self._bake_static()
+
+    def relayout(self):
+        """Fit all strips to their nodes 
+        after the nodes are placed again (see MapContainer.on_resize()).
+        
+        Nodes are baked again at once, 
+        instead of drawing themselves until the next tick.
+
+        """
+        for strip in self.strips.itervalues():
+            strip.update_geometry()
+            # Nodes are drawn in a new size even in the same area
+            strip.full = True
+            strip.repaint()
+
+        self._bake_static()
+
 class MapContainer(Node):
     """The core of the tile-based stage.
     
@@ -39,7 +279,15 @@ class MapContainer(Node):
     until it becomes half in the next cell and half in the original cell.
     Then, in the next step, it will run into the next cell.
 
+    The flags of objects (the integer attribute stageobj_flags, 
+    see module stagecontroller) are counted in a grid, 
+    so asking whether there is an object with some flag in a cell
+    does not look into the objects.
+
     """
+    # The number of flags counted in each cell
+    FLAG_BITS = 16
+
     def __init__(self, parent, style, map_size):
         """Initialize the map (the matix of cells) and 
         dictionaries for resizing.
@@ -54,6 +302,13 @@ class MapContainer(Node):
         self.__map = [ [ [] for y in xrange(0, self.map_size[1]) ] 
                 for x in xrange(0, self.map_size[0]) ]
 
+        # The flags (stageobj_flags) of objects in each cell OR'ed,
+        # and the number of objects with each flag in each cell.
+        # The index of cell (x, y) is x * map_size[1] + y.
+        cells = self.map_size[0] * self.map_size[1]
+        self.__flags = array('i', [0]) * cells
+        self.__flag_counts = array('i', [0]) * (cells * self.FLAG_BITS)
+
         # The hash key of dictionaries bellow are objects
         # delta = object's actual position - cell's position
         self.__delta = {}   
@@ -65,8 +320,17 @@ class MapContainer(Node):
         self.__orig_delta = {}      # object's original delta
         self.__orig_z_index = {}    # object's original z-index
 
+        # Positions before the current tick, of objects moved in this tick.
+        # They are used to interpolate in the fixed-step mode.
+        self.__prev_pos = {}
+        self.__lagging = set()      # objects drawn with non-zero lag
+
         self.__update_cell_size()
         self.__orig_cell_size = self.__cell_size
+
+        # Static objects are drawn by this layer
+        self.terrain = TerrainLayer(self)
+        Node.add_node(self, self.terrain)
     
     def __update_cell_size(self):
         """Update the cell size of this container (after resize)."""
@@ -75,17 +339,47 @@ class MapContainer(Node):
         self.__padding = ((self.width - self.__cell_size * self.map_size[0]) / 2,
                 (self.height - self.__cell_size * self.map_size[1]) / 2) 
 
+    def __add_flags(self, x, y, flags):
+        """Count the flags of an object entering the cell."""
+        index = x * self.map_size[1] + y
+        counts = self.__flag_counts
+        base = index * self.FLAG_BITS
+        bit = 0
+        while flags:
+            if flags & 1:
+                counts[base + bit] += 1
+                self.__flags[index] |= 1 << bit
+            flags >>= 1
+            bit += 1
+
+    def __remove_flags(self, x, y, flags):
+        """Count the flags of an object leaving the cell."""
+        index = x * self.map_size[1] + y
+        counts = self.__flag_counts
+        base = index * self.FLAG_BITS
+        bit = 0
+        while flags:
+            if flags & 1:
+                counts[base + bit] -= 1
+                if counts[base + bit] == 0:
+                    self.__flags[index] &= ~(1 << bit)
+            flags >>= 1
+            bit += 1
+
+    def __move_cell(self, node, old_cell, new_cell):
+        """Move the object between cells."""
+        self.__map[old_cell[0]][old_cell[1]].remove(node)
+        self.__map[new_cell[0]][new_cell[1]].append(node)
+        self.__cell[node] = new_cell
+        flags = getattr(node, 'stageobj_flags', 0)
+        if flags and old_cell != new_cell:
+            self.__remove_flags(old_cell[0], old_cell[1], flags)
+            self.__add_flags(new_cell[0], new_cell[1], flags)
+
     def __update_pos(self, node, x, y, width, height, z_index):
-        """Update the position (style) of target object."""
+        """Update the position (geometry) of target object."""
         dx, dy = self.__delta[node]
-        style = {
-                'left': x + dx,
-                'top': y + dy,
-                'width': width,
-                'height': height,
-                'z-index': z_index
-                }
-        node.set_style(style)
+        node.set_geometry(x + dx, y + dy, width, height, z_index)
 
     def __restrict_pos(self, x, y):
         """Check and adjust the input position 
@@ -125,7 +419,15 @@ class MapContainer(Node):
 
         """
         Node.on_resize(self)
+        old_cell_size = self.__cell_size
         self.__update_cell_size()
+        if self.__cell_size != old_cell_size:
+            # Shared rasters of objects are in the old size
+            sprite_cache.clear()
+
+        # Old positions are meaningless in the new size
+        self.__prev_pos = {}
+
         ratio = float(self.__cell_size) / self.__orig_cell_size
 
         for x, col in enumerate(self.__map):
@@ -142,6 +444,9 @@ class MapContainer(Node):
                     self.__delta[node] = (dx, dy)
                     self.__update_pos(node, pos[0], pos[1], 
                             new_width, new_height, node.z_index)
+
+        # The terrain layer is not resized itself (it is 0x0)
+        self.terrain.relayout()
     
     def get_cell_size(self):
         """Return the cell size of this map."""
@@ -161,6 +466,7 @@ class MapContainer(Node):
         ratio = float(self.__cell_size) / self.__orig_cell_size
         Node.add_node(self, node)
         self.__map[x][y].append(node)
+        self.__add_flags(x, y, getattr(node, 'stageobj_flags', 0))
         self.__delta[node] = (dx, dy)
         self.__orig_delta[node] = (dx / ratio, dy / ratio)
         self.__cell[node] = (x, y)
@@ -178,14 +484,28 @@ class MapContainer(Node):
         Also clean up the dictionary.
 
         """
+        self.terrain.discard(node)
         Node.remove_node(self, node)
         cell = self.get_cell(node)
         self.__map[cell[0]][cell[1]].remove(node)
+        self.__remove_flags(cell[0], cell[1], 
+                getattr(node, 'stageobj_flags', 0))
         del self.__delta[node]
         del self.__orig_delta[node]
         del self.__cell[node]
         del self.__orig_size[node]
         del self.__orig_z_index[node]
+        self.__prev_pos.pop(node, None)
+        self.__lagging.discard(node)
+
+    def bake(self, node, z_index=None):
+        """Draw the object added in this map by the terrain layer.
+
+        Use it for objects that are static for most of the time.
+        See TerrainLayer.bake() for the parameters.
+
+        """
+        self.terrain.bake(node, z_index)
 
     def get_cell(self, node):
         """Return the cell which target object belongs to.
@@ -201,6 +521,35 @@ class MapContainer(Node):
         """
         return self.__map[x][y]
 
+    def get_cell_flags(self, x, y):
+        """Return the flags (stageobj_flags) of all objects 
+        in target cell OR'ed."""
+        return self.__flags[x * self.map_size[1] + y]
+
+    def count_cell_flag(self, x, y, flag):
+        """Return the number of objects with the flag in target cell.
+        
+        @param flag: a single flag
+        
+        """
+        index = x * self.map_size[1] + y
+        return self.__flag_counts[index * self.FLAG_BITS 
+                + flag.bit_length() - 1]
+
+    def update_flags(self, node, old_flags):
+        """Update the flags of target cell after the flags 
+        (stageobj_flags) of the object changed.
+        
+        Nothing is done if the object is not in this map.
+
+        """
+        cell = self.__cell.get(node)
+        if cell is None:
+            return
+
+        self.__remove_flags(cell[0], cell[1], old_flags)
+        self.__add_flags(cell[0], cell[1], node.stageobj_flags)
+
     def move_to(self, node, x, y):
         """Move the object to target cell.
         
@@ -208,16 +557,16 @@ class MapContainer(Node):
         this method will make the object suddenly "jump" to target cell.
 
         """
-        cell = self.get_cell(node)
-        self.__map[cell[0]][cell[1]].remove(node)
-        self.__map[x][y].append(node)
-        self.__cell[node] = (x, y)
+        self.__move_cell(node, self.get_cell(node), (x, y))
 
         pos = self.get_cell_pos(x, y)
         self.__update_pos(node, pos[0], pos[1], 
                 node.width, node.height, 
                 self.__orig_z_index[node] + self.__get_z_index_delta(y))
+        # Don't interpolate a jump
+        self.__prev_pos.pop(node, None)
 
+    @traced('MapContainer.move_pos')
     def move_pos(self, node, delta_x, delta_y):
         """Move the object smoothly.
 
@@ -228,6 +577,9 @@ class MapContainer(Node):
         @param delta_y: the delta on y
 
         """
+        if node not in self.__prev_pos:
+            self.__prev_pos[node] = (node.x, node.y)
+
         dx, dy = self.__delta[node]
         new_x = node.x + delta_x - dx
         new_y = node.y + delta_y - dy
@@ -256,14 +608,31 @@ class MapContainer(Node):
         old_cell = self.get_cell(node)
 
         # Move the object from old cell to new cell
-        self.__map[old_cell[0]][old_cell[1]].remove(node)
-        self.__map[new_cell[0]][new_cell[1]].append(node)
-        self.__cell[node] = new_cell
+        self.__move_cell(node, old_cell, new_cell)
         self.__update_pos(node, new_x, new_y, node.width, node.height, 
                 (self.__orig_z_index[node] + 
                     self.__get_z_index_delta(new_cell[1]))
                 )
 
+    def on_tick(self, interval):
+        """Start recording the positions of a new tick."""
+        self.__prev_pos = {}
+
+    def on_interpolate(self, alpha):
+        """Draw moving objects between their last two positions."""
+        lagging = set()
+        for node, (x, y) in self.__prev_pos.iteritems():
+            lag_x = (x - node.x) * (1 - alpha)
+            lag_y = (y - node.y) * (1 - alpha)
+            if lag_x or lag_y:
+                node.set_lag(lag_x, lag_y)
+                lagging.add(node)
+
+        for node in self.__lagging - lagging:
+            node.set_lag(0, 0)
+
+        self.__lagging = lagging
+
     def get_cell_pos(self, x, y):
         """Return the position of target cell."""
         return (
@@ -419,7 +788,7 @@ class Selections(Node):
             a = (pi / 8) * (1.0 - phase)
             self.set_rotate(a * sin(phase * 8 * 2 * pi))
 
-        self._labels[self.selected].add_action('shake', _shake, duration=2, update=True)
+        self._labels[self.selected].add_action('shake', _shake, duration=2)
 
     def select_up(self):
         """Select upward."""